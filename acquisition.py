@@ -20,16 +20,21 @@
 
 import os
 import time
+import select
 import datetime as dt
 import threading
-from collections import deque
 
 from serial import (Serial, SerialException)
 from serial.tools import list_ports
 import numpy as np
 
 from edfrw import (EdfWriter, EdfHeader)
+import protocol
 from configuration import Configuration
+from buffers import (RingBuffer, RecordBuffer)
+from framing import (PacketFramer, Demultiplexer)
+from recording import EdfRecorder
+from stats import AcquisitionStats
 
 # Arduino baud rates, according to https://www.arduino.cc/en/Serial
 # /Begin: 300, 600, 1200, 2400, 4800, 9600, 14400, 19200, 28800, 38400,
@@ -61,36 +66,87 @@ def print_ports():
         print()
 
 
+# Ways of waiting for serial data (see `MCU.wait`):
+#   'select': sleep on the serial file descriptor until data arrive.
+#             This is the default on POSIX systems.
+#   'poll':   check the input buffer at regular intervals
+#             (`MCU.poll_interval`). Used where select is not available.
+READ_MODES = ('select', 'poll')
+
+
 class MCU(object):
     """
     Microcontroller unit manager.
 
     manufacturer is a string. If unsure what to use run print_ports()
     after plugging in your microcontroller and check.
+
+    read_mode is one of `READ_MODES` and sets how `wait` waits for
+    incoming data. Defaults to 'select' where available.
     """
 
-    def __init__(self, manufacturer='mbed'):
+    # Polling interval (seconds) used in 'poll' read mode.
+    poll_interval = 0.1
+    # Versions of the configuration protocol to try, in order (see
+    # `protocol`).
+    protocols = (2, 1)
+    # How long (seconds) to wait for a reply to a version 2
+    # configuration message before trying the next version.
+    _reply_timeout = 1
+
+    def __init__(self, manufacturer='mbed', read_mode=None):
         self.manufacturer = manufacturer
         self.port = None
+        self.serial = None
+        if read_mode is None:
+            read_mode = 'select' if os.name == 'posix' else 'poll'
+        if read_mode not in READ_MODES:
+            raise ValueError('Read mode {} is not supported'.format(
+                    read_mode))
+        self.read_mode = read_mode
+
+    def connect(self, baud, sampling_freq, port=None, dividers=None,
+                nsignals=None, encoding='u16'):
+        '''
+        Connect to the microcontroller. If *port* is None the serial
+        port is found by looking up the manufacturer.
+
+        *dividers* sets how often each signal is sampled, in ticks of
+        *sampling_freq* (see `framing.sampling_dividers`). By default,
+        all signals are sampled on every tick.
 
-    def connect(self, baud, sampling_freq):
+        *nsignals* is the number of signals expected, which is checked
+        against that of the microcontroller. Protocol version 2 is only
+        tried if this (or *dividers*) is given.
+
+        *encoding* is the sample encoding requested (see
+        `protocol.ENCODINGS`). The microcontroller may not support it;
+        the encoding used is `encoding` once configured.
+        '''
         self.baud = baud
         self.sampling_freq = sampling_freq
+        self.dividers = dividers
+        self.encoding = encoding
+        if nsignals is None and dividers is not None:
+            nsignals = len(dividers)
+        self.nsignals = nsignals
 
         # In case a previosly-open port was left behind.
         if self.port is not None:
             self.serial.close()
 
         # Find and connect to the microcontroller.
-        ports = [port for port in list_ports.comports()]
-        manufacturers = [port.manufacturer for port in ports]
-        try:
-            index = manufacturers.index(self.manufacturer)
-        except ValueError:
-            self.port = None
-            raise SerialException('{} not found in serial ports'.format(
-                    self.manufacturer))
-        self.port = ports[index].device
+        if port is None:
+            ports = [port for port in list_ports.comports()]
+            manufacturers = [port.manufacturer for port in ports]
+            try:
+                index = manufacturers.index(self.manufacturer)
+            except ValueError:
+                self.port = None
+                raise SerialException('{} not found in serial ports'.format(
+                        self.manufacturer))
+            port = ports[index].device
+        self.port = port
         self.serial = Serial(port=self.port, baudrate=self.baud,
                              timeout=None)
         time.sleep(0.1)
@@ -109,6 +165,113 @@ class MCU(object):
             self.serial.reset_input_buffer()
 
     def configure(self):
+        '''
+        Send the configuration to the microcontroller and check its
+        reply. The handshake protocol versions in `protocols` are tried
+        in turn (see `protocol`); the one used is `protocol_version`.
+        '''
+        self.timestamp = int(time.time())
+        for version in self.protocols:
+            if (version == 2 and self.nsignals is not None and
+                    self._configure_v2()):
+                break
+            elif version == 1:
+                self._configure_v1()
+                break
+        else:
+            self.disconnect()
+            raise SerialException(
+                    'The microcontroller does not reply to protocol '
+                    'versions {}'.format(self.protocols))
+        self.protocol_version = version
+
+    def _mismatch(self, msg):
+        # Give up on a microcontroller whose reply does not match.
+        self.disconnect()
+        raise SerialException('Microcontroller configuration mismatch. '
+                              '{}'.format(msg))
+
+    def _configure_v2(self):
+        # Send a version 2 configuration message. Returns False if the
+        # microcontroller does not reply, i.e. it does not support
+        # version 2 (and has ignored the message).
+        ticks = max(int(self.sampling_freq * protocol.PACKET_PERIOD), 1)
+        fields = [('t', self.timestamp),
+                  ('f', self.sampling_freq),
+                  ('n', self.nsignals),
+                  ('d', self.encoding),
+                  ('p', ticks)]
+        if self.dividers is not None:
+            fields.append(('s', self.dividers))
+        self.serial.write(protocol.pack(fields))
+        self.serial.timeout = self._reply_timeout
+        try:
+            reply = self.serial.readline()
+        finally:
+            self.serial.timeout = None
+        if not reply:
+            return False
+
+        try:
+            version, fields = protocol.unpack(reply)
+            seconds = int(fields['t'])
+            sampling_freq = int(fields['f'])
+            nsignals = int(fields['n'])
+            encoding = fields['d']
+            buffer_size = int(fields['b'])
+            dividers = [int(divider) for divider in
+                        fields.get('s', '').split(',') if divider]
+        except (protocol.ProtocolError, KeyError, ValueError):
+            self.disconnect()
+            print("Microcontroller's reply: ", reply)
+            raise SerialException(
+                    'Invalid configuration reply from the microcontroller')
+
+        if version != 2 or seconds != self.timestamp:
+            self._mismatch('(MCU protocol: {}, MCU time: {})'.format(
+                    version, seconds))
+        if sampling_freq != self.sampling_freq:
+            self._mismatch('The microcontroller cannot sample at {} Hz '
+                           '(MCU sampling: {} Hz, maximum: {} Hz)'.format(
+                                   self.sampling_freq, sampling_freq,
+                                   fields.get('fmax', '?')))
+        if nsignals != self.nsignals:
+            self._mismatch('The microcontroller sends {} signals but {} '
+                           'are configured'.format(nsignals, self.nsignals))
+        if encoding not in protocol.ENCODINGS:
+            self._mismatch('Unsupported sample encoding {}'.format(
+                    encoding))
+        if self.dividers is not None and (
+                dividers or [1] * nsignals) != list(self.dividers):
+            # The microcontroller samples all signals on every tick if
+            # a cycle of the dividers does not fit in a data packet.
+            self._mismatch('(MCU sampling dividers: {}, largest data '
+                           'packet: {} samples)'.format(
+                                   dividers, fields.get('bmax', '?')))
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.capabilities = fields
+        return True
+
+    def _configure_v1(self):
+        if self.sampling_freq > protocol.V1_MAX_FREQ:
+            self.disconnect()
+            raise SerialException(
+                    'The microcontroller does not support sampling '
+                    'frequencies above {} Hz (protocol version 1)'.format(
+                            protocol.V1_MAX_FREQ))
+
+        # First, the sampling divider of each signal: a 'D' followed by
+        # the dividers (3 digits each) separated by commas, and a new
+        # line, e.g. D001,002,010\n. This is sent even if all dividers
+        # are 1, to undo any previous setting. (Firmware that does not
+        # support dividers ignores these characters, and then the
+        # packet size it reports does not match.)
+        if self.dividers is not None:
+            cmd = 'D{}\n'.format(','.join(
+                    '{:03d}'.format(divider) for divider in self.dividers))
+            self.serial.write(cmd.encode('ascii'))
+
         # The microcontroller requires configuration information.
         # This is expected to be a string composed of:
         #  (1) A 'T' (one char)
@@ -116,7 +279,6 @@ class MCU(object):
         #  (3) An 'F' (one char)
         #  (4) sampling frequency in Hz (3 digits)
         #  E.g. T1234567890F100 (15 chars in total)
-        self.timestamp = int(time.time())
         cmd = 'T{:d}F{:03d}'.format(self.timestamp, self.sampling_freq)
         cmd = cmd.encode('ascii')
         assert(len(cmd) == 15)
@@ -148,244 +310,535 @@ class MCU(object):
 
         if ((int(seconds) != self.timestamp) or
             (int(sampling_freq) != self.sampling_freq)):
-            msg = ('Microcontroller configuration mismatch.' +
-                   '\n(MCU time: {}, MCU sampling: {})'.format(
-                           seconds, sampling_freq))
-            self.disconnect()
-            raise SerialException(msg)
+            self._mismatch('\n(MCU time: {}, MCU sampling: {})'.format(
+                    seconds, sampling_freq))
         self.buffer_size = int(buffer_size)
+        self.encoding = 'u16'
+        self.capabilities = {}
 
     def read(self, nbytes):
         return self.serial.read(nbytes)
 
+    def readinto(self, buffer):
+        '''
+        Read data from the serial port into *buffer*, a writable
+        bytes-like object (e.g. a `memoryview` of a `bytearray`).
+        Returns the number of bytes read.
+
+        Only the data already waiting in the input buffer are read. On
+        POSIX systems the data are read directly from the port's file
+        descriptor into *buffer* without creating intermediate objects.
+        '''
+        nbytes = min(len(buffer), self.serial.in_waiting)
+        if nbytes == 0:
+            return 0
+        if os.name == 'posix':
+            return os.readv(self.serial.fileno(), [buffer[:nbytes]])
+        return self.serial.readinto(buffer[:nbytes])
+
+    def wait(self, nbytes, timeout):
+        '''
+        Wait until there are at least *nbytes* in the input buffer or
+        until *timeout* seconds have passed, whichever happens first.
+        Returns the number of bytes waiting in the input buffer.
+        '''
+        deadline = time.monotonic() + timeout
+        waiting = self.serial.in_waiting
+        while waiting < nbytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.read_mode == 'select':
+                # Sleep until new data arrive. If these are not enough,
+                # sleep for as long as the missing bytes take to be
+                # transmitted (10 bits per byte with start and stop
+                # bits) rather than waking up on every byte.
+                select.select([self.serial.fileno()], [], [], remaining)
+                waiting = self.serial.in_waiting
+                if 0 < waiting < nbytes:
+                    missing = (nbytes - waiting) * 10 / self.baud
+                    time.sleep(min(missing, max(
+                            deadline - time.monotonic(), 0)))
+            else:
+                time.sleep(min(self.poll_interval, remaining))
+            waiting = self.serial.in_waiting
+        return waiting
+
     @property
     def in_waiting(self):
         return self.serial.in_waiting
 
+    @property
+    def connected(self):
+        '''
+        Whether the serial port is open (read-only).
+        '''
+        return self.serial is not None and self.serial.is_open
+
     def disconnect(self):
-        self.reset()
-        time.sleep(0.01)
-        self.serial.close()
+        # The port may have gone (e.g. the device was unplugged); close
+        # it anyway.
+        try:
+            self.reset()
+            time.sleep(0.01)
+        except (SerialException, OSError):
+            pass
+        finally:
+            self.serial.close()
 
 
 class DataAcquisition(object):
 
     _start = b'\xff\xff\xff\xff'
     _start_size = 4
-
-    def __init__(self, microcontroller='mbed'):
+    # By design incoming data samples are two bytes long.
+    _dtype = np.dtype('<u2')
+
+    # How long (seconds) the reader thread waits for a data packet
+    # before checking again whether it should stop.
+    _read_timeout = 0.5
+    # How long (seconds) to wait for the first data packet.
+    _sync_timeout = 3
+    # The input buffer of a serial port (a tty) holds at most 4095
+    # bytes, so waiting for a larger data packet to arrive in full would
+    # only time out. Packets larger than this are read in pieces.
+    _max_wait = 2048
+    # Seconds of data that the display buffers hold beyond the display
+    # window. The display may take this long to read the window before
+    # the reader thread overwrites it.
+    _display_slack = 2
+
+    def __init__(self, microcontroller='mbed', read_mode=None, port=None):
+        '''
+        *port* is the serial port of the microcontroller. If None, the
+        port is found by looking up the microcontroller's manufacturer.
+        '''
         self.config = Configuration()
 
         # Public variables
-        self.mcu = MCU(microcontroller)
-        self.x = None
+        self.mcu = MCU(microcontroller, read_mode)
+        self.port = port
         self.y = None
 
         # Private variables.
-        self._edffile = None
-        self._iobuffer = None
+        self._recorder = None
+        self._record_buffer = None
+        self._framer = None
+        # Splits the data packets if signals have different sampling
+        # frequencies.
+        self._demultiplexer = None
+        self._stats = AcquisitionStats()
 
         # Flags for flow control
         self._read_flag = False
+        self._thread = None
+        # Held by the reader thread while adding samples to the data
+        # record, so that recording starts and stops at a packet
+        # boundary.
+        self._record_lock = threading.Lock()
+
+    @property
+    def running(self):
+        '''
+        Whether data are being acquired (read-only).
+        '''
+        return self._read_flag
+
+    @property
+    def recording(self):
+        '''
+        Whether data are being saved to file (read-only).
+        '''
+        return self._record_buffer is not None
 
     @property
     def edffile(self):
-        if self._edffile is None or self._edffile.closed:
-            self._iomaxlen = 0
-            self._edffile = None
-        return self._edffile
+        '''
+        The EDF file being recorded, or None (read-only).
+        '''
+        if self._recorder is None or self._recorder.edffile.closed:
+            return None
+        return self._recorder.edffile
+
+    @property
+    def recorder(self):
+        '''
+        The `recording.EdfRecorder` writing the data to file, or None if
+        not recording (read-only). Its counters show the depth of the
+        queue of data records waiting to be written, write latency, and
+        the number of records dropped.
+        '''
+        return self._recorder
+
+    def stats(self):
+        '''
+        Return a snapshot of the acquisition counters, as a dictionary:
+
+            elapsed         Seconds since acquisition started.
+            bytes_read      Bytes read from the serial port...
+            reads           ...in these many reads.
+            max_in_waiting  Largest serial backlog (bytes waiting in
+                            the input buffer) found.
+            packets         Data packets received.
+            resyncs         Times the start sequence was lost.
+            dropped_bytes   Bytes discarded while looking for the start
+                            sequence.
+            ambiguous_headers
+                            Packed samples (p12) only: start sequences
+                            next to a saturated sample, where a lost
+                            byte may go unnoticed and shift the data.
+            stages          Time spent on each stage of the reading
+                            loop (see `stats.STAGES`), as histograms.
+            recorder        Counters of the EDF writer (see
+                            `recording.EdfRecorder.stats`), or None if
+                            not recording. The queue depth and write
+                            latency show how far behind the writer is.
+        '''
+        snapshot = self._stats.snapshot()
+        framer = self._framer
+        snapshot['packets'] = framer.packets if framer else 0
+        snapshot['resyncs'] = framer.resyncs if framer else 0
+        snapshot['dropped_bytes'] = framer.dropped_bytes if framer else 0
+        snapshot['ambiguous_headers'] = (framer.ambiguous_headers
+                                         if framer else 0)
+        recorder = self._recorder
+        snapshot['recorder'] = recorder.stats() if recorder else None
+        return snapshot
 
     def start(self, seconds=10):
         '''
         Connect and read serial input. Configuration must be done
         beforehand.
 
-        'seconds' is the length of data to keep in self.x and self.y to
-        be displayed.
+        'seconds' is the length of data to keep in self.y to be
+        displayed. This is a ring buffer (see `buffers.RingBuffer`) of
+        the samples (samples x signals) in their native uint16 type.
+        Samples are numbered from 0, the first sample acquired, and the
+        number of each one is its row number in the buffer: the latest
+        sample is number ``self.y.count - 1``. Their time is given by
+        `sample_time`. Rows are taken at the base sampling frequency;
+        signals sampled less often repeat their last sample.
+
+        Raises ValueError if the sampling frequency of a signal is not
+        a divisor of the base sampling frequency, or if the data would
+        overrun the serial link (see `Configuration.check_link`).
+
+        The reader thread adds samples to the buffer without locking it,
+        so it is never held up by the display. The display reads it as
+        described in `buffers.RingBuffer`: take `self.y.count`, copy the
+        rows needed with `tail`, and check that they are still `intact`.
         '''
         # Do nothing if reading is already in progress.
         if self._read_flag is True:
             return
+        dividers = self.config.dividers
+        self.config.check_link()
 
         # Initialise data buffers.
         maxlen = seconds * self.config.sampling_freq
-        self.y = deque([np.ones(self.config.nsignals) * np.nan],
-                       maxlen=maxlen)
-        self.x = deque([0], maxlen=maxlen)
+        slack = self._display_slack * self.config.sampling_freq
+        self.y = self._display_buffer(maxlen, slack)
 
         # Connect to microcontroller
         self.mcu.connect(baud=self.config.baud,
-                         sampling_freq=self.config.sampling_freq)
+                         sampling_freq=self.config.sampling_freq,
+                         port=self.port, dividers=dividers,
+                         nsignals=self.config.nsignals,
+                         encoding=self.config.encoding)
         self.mcu.configure()
+        if self.mcu.encoding != self.config.encoding:
+            # The microcontroller does not support the encoding
+            # requested and sends e.g. unpacked samples instead, which
+            # may be too much data for the link.
+            rate = protocol.data_rate(self.config.sampling_freq,
+                                      dividers, self.mcu.encoding)
+            if rate > self.config.link_capacity():
+                self.mcu.disconnect()
+                raise SerialException(
+                        'The microcontroller does not support {} samples, '
+                        'and {:.0f} bytes/s of {} samples overrun the '
+                        'serial link'.format(self.config.encoding, rate,
+                                             self.mcu.encoding))
+        if (not self.config.multirate and
+                self.mcu.buffer_size % self.config.nsignals):
+            self.mcu.disconnect()
+            raise SerialException(
+                    'Microcontroller configuration mismatch. Its data '
+                    'packets ({} samples) do not match the number of '
+                    'signals ({})'.format(self.mcu.buffer_size,
+                                          self.config.nsignals))
+        self._demultiplexer = None
+        if self.config.multirate:
+            try:
+                self._demultiplexer = Demultiplexer(dividers,
+                                                    self.mcu.buffer_size)
+            except ValueError as error:
+                self.mcu.disconnect()
+                raise SerialException(
+                        'Microcontroller configuration mismatch. Does '
+                        'it support per-signal sampling frequencies? '
+                        '({})'.format(error))
 
         # Set flags and start thread for reading data
+        self._stats.clear()
         self._read_flag = True
-        self.lock = threading.Lock()
         self._thread = threading.Thread(target=self._read,
                                         name='Read-data')
         #self._thread.daemon = True
         self._thread.start()
 
+    def _display_buffer(self, maxlen, slack):
+        '''
+        Create the display buffer self.y.
+        '''
+        return RingBuffer(maxlen, self.config.nsignals, dtype='uint16',
+                          slack=slack)
+
+    def sample_time(self, index, absolute=False):
+        '''
+        Return the time in seconds of the sample(s) number *index*
+        (see `start`), counted from the first sample acquired. If
+        *absolute* is True, the time is in seconds since the epoch,
+        taking as start time that set in the microcontroller.
+
+        Times are computed from the sample numbers, which are integers,
+        so they do not accumulate rounding errors.
+        '''
+        seconds = np.asarray(index) / self.config.sampling_freq
+        if absolute:
+            seconds = seconds + self.mcu.timestamp
+        return seconds
+
     def stop(self):
-        # Do nothing if reading is not in progress.
-        if self._read_flag is False:
-            return
-        # Cancel data-reading thread
-        self._read_flag = False
-        self.y = None
-        self.x = None
-        self._iobuffer = None
-        self._thread.join()
-        self.mcu.disconnect()
+        '''
+        Stop recording and data acquisition. What is torn down depends
+        on what is still active, not on `running`: the reader thread
+        stops by itself if the start sequence is missing, and then this
+        still closes the file and disconnects.
+        '''
+        try:
+            self.stop_recording()
+        finally:
+            # Cancel data-reading thread. The display buffers are left
+            # as they are, with the last data read.
+            self._read_flag = False
+            if self._thread is not None:
+                self._thread.join()
+                self._thread = None
+            if self.mcu.connected:
+                self.mcu.disconnect()
 
     def _read(self):
         '''
         Read serial data repeatedly.
         '''
-        # By design incoming data samples are two bytes long.
-        serial_dtype = np.dtype('uint16')
-
-        # Number of bytes to expect from microcontroller at every
-        # iteration (i.e. packet size).
-        nbytes = (self._start_size +
-                  (self.mcu.buffer_size * serial_dtype.itemsize))
-
-        # Find the header at the start of each data packet. Timeout
-        # after 3 seconds if the header is not received.
-        timeout = 3
-        timer = threading.Timer(timeout, self.stop)
-        timer.start()
-        start = self.mcu.read(self._start_size)
-        while start != self._start:
-            start = start[1:] + self.mcu.read(1)
-        timer.cancel()
-
-        while self._read_flag:
-            # The size of the serial buffer is 4096 (2**12) bytes.
-            # Print a warning if we get close to this value. Useful
-            # for debugging.
-            # if self.serial.bytesAvailable() > 4000:
-            # if self.serial.in_waiting > 4000:
-            #    print('Warning: buffer overflowing')
-
-            # Wait until the incoming buffer has enough values. Then
-            # read serial data.
-            while self.mcu.in_waiting < nbytes:
-                time.sleep(0.1)
-            samples = self.mcu.read(nbytes)
-
-            # The data just read should be the set of samples delimited
-            # by the start sequence. Here the data are split into these
-            # two groups with `partition`, which - if all is good -
-            # should return three items: the samples before the start
-            # sequence, the start sequence itself, and the samples after
-            # the start sequence. The start sequence was read once
-            # before (above), so from now on it will appear at the end
-            # of each data set. Thus, `after` should always be empty.
-            samples, start, after = samples.partition(self._start)
-            assert(len(after) == 0)
-
-            # If the start sequence was not found, `partition` will
-            # return an empty start. If that happens top acquiring data.
-            if start == b'':
-                print('Missing start sequence.')
-                self._read_flag = False
-            # If all is fine unpack the data and push into buffers as
-            # required.
-            else:
-                # Convert data bytes into required data type (uint16
-                # by default).
-                samples = np.frombuffer(samples, dtype=serial_dtype)
-
-                # If the standard buffer is active, add the newly-
-                # read samples to it.
-                if self.y is not None:
-                    y = np.reshape(samples,
-                                   (-1, self.config.nsignals))
-                    x = np.arange(len(y)) / self.config.sampling_freq
-                    x = x + self.x[-1] + (1/self.config.sampling_freq)
-                    self.x.extend(x)
-                    self.y.extend(y)
-
-                # If the input/output buffer is active, add the
-                # newly-read samples to it.
-                if self._iobuffer is not None:
-                    self._iobuffer.extend(samples)
-                    if len(self._iobuffer) == self._iomaxlen:
-                        # reshape buffer
-                        samples = np.reshape(self._iobuffer,
-                                            (-1, self.config.nsignals))
-                        samples = samples.flatten(order='F')
-                        # write to file
-                        self.edffile.write_data_record(samples)
-                        self.edffile.flush()
-                        # reset buffer
-                        self._iobuffer.clear()
-
-    def start_recording(self):
+        # The framer splits the incoming data into packets, each made
+        # of the start sequence followed by `buffer_size` samples. If
+        # signals are sampled at different frequencies the samples are
+        # not in rows of one sample per signal; instead, the framer
+        # returns one row per packet, which `_push` demultiplexes.
+        row_size = self.config.nsignals
+        if self._demultiplexer is not None:
+            row_size = self.mcu.buffer_size
+        framer = PacketFramer(self.mcu.buffer_size, row_size,
+                              dtype=self._dtype, header=self._start,
+                              packed=self.mcu.encoding == 'p12')
+        self._framer = framer
+        stats = self._stats
+        wait_time = stats.stages['wait']
+        read_time = stats.stages['read']
+        frame_time = stats.stages['frame']
+
+        # Stop if no data packet is received within `_sync_timeout`
+        # seconds.
+        start = time.monotonic()
+
+        # An error reading the port (e.g. the device is unplugged) also
+        # stops the acquisition, so that `stop` tears it down.
+        try:
+            while self._read_flag:
+                # The size of the serial buffer is 4096 (2**12) bytes.
+                # Print a warning if we get close to this value. Useful
+                # for debugging.
+                # if self.serial.bytesAvailable() > 4000:
+                # if self.serial.in_waiting > 4000:
+                #    print('Warning: buffer overflowing')
+
+                # Wait until the incoming buffer has at least one packet.
+                # Then read all the data that are waiting (as much as the
+                # framer can take) and extract all the complete packets in
+                # one go.
+                t0 = time.perf_counter()
+                waiting = self.mcu.wait(min(framer.packet_size,
+                                            self._max_wait),
+                                        self._read_timeout)
+                t1 = time.perf_counter()
+                wait_time.add(t1 - t0)
+                if waiting:
+                    if waiting > stats.max_in_waiting:
+                        stats.max_in_waiting = waiting
+                    nbytes = self.mcu.readinto(framer.reserve(waiting))
+                    framer.commit(nbytes)
+                    t2 = time.perf_counter()
+                    samples = framer.frame()
+                    t3 = time.perf_counter()
+                    read_time.add(t2 - t1)
+                    frame_time.add(t3 - t2)
+                    stats.bytes_read += nbytes
+                    stats.reads += 1
+                    if len(samples):
+                        self._push(samples)
+
+                if (not framer.synchronised and
+                        time.monotonic() - start > self._sync_timeout):
+                    print('Missing start sequence.')
+                    self._read_flag = False
+        except (SerialException, OSError) as error:
+            print('Error reading {}: {}'.format(self.mcu.port, error))
+        finally:
+            self._read_flag = False
+
+    def _push(self, samples):
+        '''
+        Push newly-read samples (a 2-D array, samples x signals; or
+        packets x samples if signals have different sampling
+        frequencies) into the buffers.
+        '''
+        stages = self._stats.stages
+        demultiplexer = self._demultiplexer
+        t0 = time.perf_counter()
+        # Both buffers are extended under the lock, so that the samples
+        # recorded start right after those counted in the display buffer
+        # when recording starts (see `start_recording`).
+        with self._record_lock:
+            # If the standard buffer is active, add the newly-read
+            # samples to it.
+            if self.y is not None:
+                if demultiplexer is None:
+                    self.y.extend(samples)
+                else:
+                    self.y.extend(demultiplexer.expand(samples))
+
+            # If recording, add the newly-read samples to the current
+            # data record. Complete records are written to file.
+            t1 = time.perf_counter()
+            record_buffer = self._record_buffer
+            if record_buffer is not None and demultiplexer is None:
+                record_buffer.extend(samples)
+            elif record_buffer is not None:
+                record_buffer.extend_channels(demultiplexer.split(samples))
+        t2 = time.perf_counter()
+        stages['display'].add(t1 - t0)
+        stages['record'].add(t2 - t1)
+
+    def start_recording(self, policy=None, rotation=None, filename=None):
         '''
         Save data to file.
 
-        61440 bytes per datarecord
-
-        sum of :
-            saving_period_s * signal.number_of_samples_in_data_record * 2
-        for all signals must be <= 61440
+        *filename* is the name of the EDF file. By default, the file is
+        saved in the configuration's data path and named after the
+        subject code and the current date and time.
 
-        so when setting signals,
+        *policy* is a `recording.FlushPolicy` that sets how often data
+        are flushed to disk. By default the file is flushed after every
+        data record.
 
-        Recall relationships:
-            header.duration_of_data_record == saving_period_s
+        *rotation* is a `recording.RotationPolicy` that splits the
+        recording into several files of fixed duration or size. The
+        files are named after the recording plus a sequence number
+        (e.g. 'ID2020_2017-05-09_17_01_46_000.edf') and listed in a
+        manifest ('ID2020_2017-05-09_17_01_46.json').
 
-            and
-                signal.number_of_samples_in_data_record = (
-                    signal.sampling_freq * saving_period_s)
+        If data acquisition is already running, recording starts with
+        the next data packet received, without interrupting the
+        acquisition; otherwise acquisition is started first.
 
-        work backwards,
-        num of bytes in 1 second is
-        bytes_per_sec = sum(signal.sampling_freq * 2 for signal in signals)
+        Each data record holds `Configuration.record_duration` seconds
+        of data: `saving_period_s`, or less if a data record would
+        otherwise exceed the 61440 bytes allowed by EDF. Raises
+        ValueError if no valid duration exists.
+        '''
+        # Do nothing if already recording.
+        if self.recording:
+            return
+        # Check that the data records can be written before starting.
+        duration = self.config.record_duration
+        if not self.running:
+            self.start()
+
+        # Number of samples of each signal in a data record. When the
+        # record buffer fills up with these many samples the data record
+        # is handed over to the recorder, which writes it to disk in a
+        # separate thread.
+        n_samples = [int(signal.sampling_freq * duration)
+                     for signal in self.config.signals]
+        record_buffer = RecordBuffer(n_samples, None, dtype=self._dtype)
+
+        # The reader thread adds samples to the record buffer from the
+        # next data packet on, once attached. The file starts at the
+        # time of the first of these samples (see `sample_time`), not at
+        # the current time, which is later by the time taken to read and
+        # frame the data. The reader waits while the file is created, so
+        # that no sample goes by in between.
+        with self._record_lock:
+            start = dt.datetime.fromtimestamp(
+                    float(self.sample_time(self.y.count, absolute=True)))
+
+            # Filename format e.g.: 'ID2020_2017-05-09_17_01_46.edf'
+            if filename is None:
+                basename = '{}_{:%Y-%m-%d_%H_%M_%S}'.format(
+                        self.config.subject_id.code, start)
+                basename = os.path.join(self.config.data_path, basename)
+            else:
+                basename = os.path.splitext(filename)[0]
 
-        thus max seconds allowed:
-        max_saving_period = floor(61440 / bytes_per_sec)
+            def open_segment(index, date_time):
+                filename = '{}_{:03d}.edf'.format(basename, index)
+                return self._open_edf(filename, date_time, duration)
 
-        '''
-        # TODO: There can be max 61440 bytes per datarecord
+            if rotation is None:
+                edffile = self._open_edf(basename + '.edf', start,
+                                         duration)
+            else:
+                edffile = open_segment(0, start)
 
-        # Filename format e.g.: 'ID2020_2017-05-09_17.01.46.edf'
-        now = dt.datetime.now()
-        filename = '{}_{:%Y-%m-%d_%H_%M_%S}.edf'.format(
-                self.config.subject_id.code, now)
-        filename = os.path.join(self.config.data_path, filename)
+            self._recorder = EdfRecorder(edffile, record_buffer.size,
+                                         dtype=self._dtype, policy=policy,
+                                         rotation=rotation,
+                                         open_segment=open_segment,
+                                         manifest=basename + '.json')
+            record_buffer.callback = self._recorder.submit
+            self._record_buffer = record_buffer
 
-        edf_header = EdfHeader(date_time = now,
+    def _open_edf(self, filename, date_time, duration):
+        '''
+        Create a new EDF file for the current configuration, with data
+        records of *duration* seconds.
+        '''
+        edf_header = EdfHeader(date_time = date_time,
                                signals = self.config.signals)
         edf_header.subject_id = self.config.subject_id
         edf_header.recording_id = self.config.recording_id
 
-        self._edffile = EdfWriter(
+        return EdfWriter(
                 filename,
                 header=edf_header,
-                saving_period_s=self.config.saving_period_s)
-
-        # Number of samples in data record: the sum of each signal's
-        # number_of_samples_in_data_record. When the buffer fills up
-        # with these many samples the data are flushed to disk.
-        n_samples = [(signal.sampling_freq *
-                      self.config.saving_period_s) for
-                     signal in self.config.signals]
-        self._iomaxlen = np.sum(n_samples)
-
-        self.stop()
-        self._iobuffer = deque()
-        self.start()
+                saving_period_s=duration)
 
     def stop_recording(self):
-        if self._iobuffer is None:
+        '''
+        Stop saving data to file. Data acquisition continues.
+        '''
+        if self._record_buffer is None:
             return
-        # TODO Add option to wait for last data record to be flushed to
-        # disk before closing down.
-        self.stop()
-        self.edffile.close()
+        # Detach the record buffer (waiting for the reader thread to
+        # finish with the current data packet, if needed). An incomplete
+        # last data record is discarded.
+        with self._record_lock:
+            self._record_buffer = None
+        # Wait for the data records still in the queue to be written
+        # and close the file.
+        self._recorder.close()
 
 
 if __name__ == '__main__':
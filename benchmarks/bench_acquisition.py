@@ -0,0 +1,248 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Throughput and latency of the acquisition pipeline.
+
+`DataAcquisition` reads data from a simulated microcontroller (see
+`simulator.py`) for every combination of number of signals, sampling
+rate and packet period (seconds of data per packet) given. For each of
+them the following are measured:
+
+    samples_per_s   Samples (all signals) received per second.
+    received        Fraction of the samples sent that were received; if
+                    below 1 the reader did not keep up.
+    chunk_ms        Percentiles of the time taken to read, frame and
+                    push (`DataAcquisition._push`) each chunk of
+                    samples, in ms; the wait for data is not included.
+    cpu_percent     CPU time of the reading process over wall time.
+    peak_rss_kb     Peak resident memory of the reading process.
+    first_sample_s  Time from `DataAcquisition.start` to the first
+                    samples being available.
+
+Each combination runs in a new process, with the simulator in yet
+another one, so that CPU and memory figures are not mixed up. Results
+are printed and saved as JSON so that runs can be compared across
+versions:
+
+    python3 benchmarks/bench_acquisition.py --signals 3 16 64 \\
+        --rates 250 500 --output results.json
+
+Linux only (requires a pty).
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PERCENTILES = (50, 90, 99, 100)
+
+
+def start_simulator(nsignals, packet_period, baud):
+    simulator = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'simulator.py'),
+             '--nsignals', str(nsignals), '--baud', str(baud),
+             '--packet-period', str(packet_period)],
+            stdout=subprocess.PIPE, universal_newlines=True)
+    # The simulator prints the name of its pseudo-terminal.
+    port = simulator.stdout.readline().split()[-1]
+    return simulator, port
+
+
+def run(nsignals, rate, packet_period, seconds, baud):
+    '''
+    Acquire data from the simulator for *seconds* and return the
+    measurements as a dictionary.
+    '''
+    from edfrw import EdfSignal
+    from acquisition import DataAcquisition
+
+    simulator, port = start_simulator(nsignals, packet_period, baud)
+
+    # Stop the simulator whatever happens; if left running it holds
+    # on to this process' output, and the driver waits for it forever.
+    daq = None
+    try:
+        daq = DataAcquisition(port=port)
+        daq.config.sampling_freq = rate
+        daq.config.signals = [EdfSignal(label='Signal {}'.format(n+1),
+                                        sampling_freq=rate)
+                              for n in range(nsignals)]
+        # With no baud rate the simulated link is as fast as USB CDC;
+        # otherwise the configuration must match the link.
+        if baud:
+            daq.config.baud = daq.config.max_baud = baud
+        else:
+            daq.config.usb_cdc = True
+
+        # Time each chunk of samples from the moment the reader thread
+        # reads it from the port until `_push` has handled it, i.e.
+        # reading, framing and pushing. The wait for data is left out.
+        chunk_times = []
+        received = [0]
+        first_sample = []
+        read_start = [None]
+        readinto = daq.mcu.readinto
+        push = daq._push
+
+        def timed_readinto(buffer):
+            read_start[0] = time.perf_counter()
+            return readinto(buffer)
+
+        def timed_push(samples):
+            push(samples)
+            t1 = time.perf_counter()
+            if not first_sample:
+                first_sample.append(t1)
+            chunk_times.append(t1 - read_start[0])
+            received[0] += samples.size
+
+        daq.mcu.readinto = timed_readinto
+        daq._push = timed_push
+
+        t_start = time.perf_counter()
+        daq.start()
+        # Measure once the first data have arrived.
+        while not first_sample and time.perf_counter() - t_start < 5:
+            time.sleep(0.01)
+        del chunk_times[:]
+        received[0] = 0
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        time.sleep(seconds)
+        cpu = time.process_time() - cpu0
+        wall = time.perf_counter() - wall0
+        nreceived = received[0]
+    finally:
+        try:
+            if daq is not None:
+                daq.stop()
+        finally:
+            simulator.terminate()
+            simulator.wait()
+
+    times = np.array(chunk_times) * 1e3
+    expected = nsignals * rate * wall
+    return {
+        'nsignals': nsignals,
+        'rate': rate,
+        'packet_period': packet_period,
+        'samples_per_s': nreceived / wall,
+        'received': nreceived / expected if expected else 0,
+        'chunks': len(times),
+        'chunk_ms': {'p{}'.format(p): (float(np.percentile(times, p))
+                                       if len(times) else None)
+                     for p in PERCENTILES},
+        'cpu_percent': 100 * cpu / wall,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'first_sample_s': (first_sample[0] - t_start
+                           if first_sample else None),
+        }
+
+
+def version():
+    try:
+        return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--signals', type=int, nargs='+',
+                        default=[3, 16, 64])
+    parser.add_argument('--rates', type=int, nargs='+',
+                        default=[100, 500, 999],
+                        help='sampling frequencies (Hz)')
+    parser.add_argument('--packet-periods', type=float, nargs='+',
+                        default=[0.05, 0.2],
+                        help='seconds of data per packet')
+    parser.add_argument('--seconds', type=float, default=5,
+                        help='duration of each run')
+    parser.add_argument('--baud', type=int, default=0,
+                        help='baud rate of the simulated link '
+                             '(0: unlimited)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file where to save the results')
+    # Used internally to run a single combination in a new process.
+    parser.add_argument('--single', type=float, nargs=3, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        nsignals, rate, packet_period = args.single
+        result = run(int(nsignals), int(rate), packet_period,
+                     args.seconds, args.baud)
+        print(json.dumps(result))
+        return
+
+    print('{:>8}{:>6}{:>8}{:>12}{:>10}{:>10}{:>10}{:>8}{:>10}{:>8}'.format(
+            'signals', 'Hz', 'packet', 'samples/s', 'received',
+            'p50 ms', 'p99 ms', 'CPU %', 'RSS MB', 'TTFS'))
+    results = []
+    for nsignals in args.signals:
+        for rate in args.rates:
+            for packet_period in args.packet_periods:
+                output = subprocess.check_output(
+                        [sys.executable, os.path.abspath(__file__),
+                         '--single', str(nsignals), str(rate),
+                         str(packet_period), '--seconds',
+                         str(args.seconds), '--baud', str(args.baud)],
+                        universal_newlines=True)
+                result = json.loads(output.strip().split('\n')[-1])
+                results.append(result)
+                chunk_ms = result['chunk_ms']
+                print('{:>8}{:>6}{:>8}{:>12.0f}{:>10.3f}{:>10.3f}'
+                      '{:>10.3f}{:>8.1f}{:>10.1f}{:>8.2f}'.format(
+                        nsignals, rate, packet_period,
+                        result['samples_per_s'], result['received'],
+                        chunk_ms['p50'] or 0, chunk_ms['p99'] or 0,
+                        result['cpu_percent'],
+                        result['peak_rss_kb'] / 1024,
+                        result['first_sample_s'] or 0))
+
+    if args.output is not None:
+        report = {
+            'version': version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seconds': args.seconds,
+            'baud': args.baud,
+            'results': results,
+            }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
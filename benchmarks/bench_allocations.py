@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Memory allocations in the serial reading loop.
+
+Data packets are streamed through a pseudo-terminal and read as
+`DataAcquisition._read` does (`MCU.readinto` into the framer's buffer,
+framing, and copy into the display ring buffer). Every second the number
+of allocated memory blocks and the memory traced by `tracemalloc` are
+printed; in a healthy loop both stay flat.
+
+    python3 benchmarks/bench_allocations.py --seconds 10
+
+Linux only (requires a pty).
+'''
+
+import os
+import sys
+import time
+import threading
+import argparse
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+from acquisition import MCU
+from buffers import RingBuffer
+from framing import PacketFramer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--nsignals', type=int, default=8)
+    parser.add_argument('--rate', type=int, default=1000,
+                        help='sampling frequency (Hz)')
+    args = parser.parse_args()
+
+    # One packet every 0.2 s, as sent by the mbed firmware.
+    nsamples = int(args.rate * 0.2) * args.nsignals
+    samples = np.arange(nsamples) % 4096
+    packet = b'\xff' * 4 + samples.astype('<u2').tobytes()
+
+    master, slave = os.openpty()
+    mcu = MCU()
+    mcu.connect(baud=115200, sampling_freq=args.rate,
+                port=os.ttyname(slave))
+    framer = PacketFramer(nsamples, args.nsignals)
+    ring = RingBuffer(10 * args.rate, args.nsignals)
+
+    running = True
+
+    def write():
+        while running:
+            os.write(master, packet)
+            time.sleep(0.2)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+
+    tracemalloc.start()
+    print('{:>6}{:>10}{:>12}{:>14}'.format(
+            'time', 'packets', 'blocks', 'traced bytes'))
+    t0 = time.monotonic()
+    next_report = t0
+    while time.monotonic() - t0 < args.seconds:
+        waiting = mcu.wait(framer.packet_size, 0.5)
+        if waiting:
+            framer.commit(mcu.readinto(framer.reserve(waiting)))
+            rows = framer.frame()
+            if len(rows):
+                ring.extend(rows)
+        if time.monotonic() >= next_report:
+            print('{:>6.0f}{:>10}{:>12}{:>14}'.format(
+                    time.monotonic() - t0, framer.packets,
+                    sys.getallocatedblocks(),
+                    tracemalloc.get_traced_memory()[0]))
+            next_report += 1
+
+    running = False
+    writer.join()
+    tracemalloc.stop()
+    mcu.serial.close()
+    os.close(master)
+    os.close(slave)
+
+
+if __name__ == '__main__':
+    main()
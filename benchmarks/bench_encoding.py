@@ -0,0 +1,120 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Cost and benefit of the packed 12-bit sample encoding ('p12').
+
+First, the time taken by `framing.PacketFramer` to extract the samples
+of a stream of packets, with samples sent as uint16 ('u16') or packed.
+Then, for each number of signals, the highest sampling frequency whose
+data fit in the serial link at the given baud rate with each encoding
+(see `protocol.data_rate`).
+
+    python3 benchmarks/bench_encoding.py --baud 115200
+'''
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+from framing import (PacketFramer, pack_p12)
+import protocol
+from configuration import BITS_PER_BYTE
+
+
+def make_stream(npackets, nsamples, encoding, seed=0):
+    rng = np.random.RandomState(seed)
+    samples = rng.randint(0, 0x1000, size=(npackets, nsamples))
+    header = b'\xff\xff\xff\xff'
+    if encoding == 'p12':
+        packets = [header + pack_p12(row) for row in samples]
+    else:
+        packets = [header + row.astype('<u2').tobytes() for row in samples]
+    return b''.join(packets)
+
+
+def decode_time(stream, nsamples, encoding, chunk=4096):
+    # Seconds taken to frame and decode the whole stream.
+    packet_size = (protocol.HEADER_BYTES +
+                   protocol.payload_size(nsamples, encoding))
+    framer = PacketFramer(nsamples, 1, packed=encoding == 'p12',
+                          capacity=1 + max(2, 2 * chunk // packet_size))
+    t0 = time.perf_counter()
+    for start in range(0, len(stream), chunk):
+        data = stream[start:start+chunk]
+        framer.feed(data[:framer.space])
+        framer.frame()
+    return time.perf_counter() - t0, framer.packets
+
+
+def ceiling(nsignals, encoding, capacity, max_freq):
+    # Highest sampling frequency (Hz) at which `nsignals` fit in a link
+    # carrying `capacity` bytes/s.
+    dividers = [1] * nsignals
+    best = 0
+    for freq in range(1, max_freq + 1):
+        if protocol.data_rate(freq, dividers, encoding) <= capacity:
+            best = freq
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--nsamples', type=int, default=150,
+                        help='samples per packet')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--signals', type=int, nargs='+',
+                        default=[1, 2, 3, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    print('Decoding {} packets of {} samples'.format(args.packets,
+                                                    args.nsamples))
+    print('{:>10}{:>12}{:>12}{:>12}'.format(
+            'encoding', 'MB/s', 'Msamples/s', 'ns/sample'))
+    for encoding in protocol.ENCODINGS:
+        stream = make_stream(args.packets, args.nsamples, encoding)
+        elapsed, npackets = decode_time(stream, args.nsamples, encoding)
+        nsamples = npackets * args.nsamples
+        print('{:>10}{:>12.1f}{:>12.1f}{:>12.2f}'.format(
+                encoding, len(stream) / elapsed / 1e6,
+                nsamples / elapsed / 1e6, elapsed / nsamples * 1e9))
+
+    capacity = args.baud / BITS_PER_BYTE
+    max_freq = int(capacity)
+    print()
+    print('Highest sampling frequency (Hz) at {} baud'.format(args.baud))
+    print('{:>10}{:>10}{:>10}{:>10}{:>14}'.format(
+            'signals', 'u16', 'p12', 'gain', 'p12 samples/s'))
+    for nsignals in args.signals:
+        freqs = [ceiling(nsignals, encoding, capacity, max_freq)
+                 for encoding in ('u16', 'p12')]
+        print('{:>10}{:>10}{:>10}{:>9.0%}{:>14}'.format(
+                nsignals, freqs[0], freqs[1], freqs[1] / freqs[0] - 1,
+                nsignals * freqs[1]))
+
+
+if __name__ == '__main__':
+    main()
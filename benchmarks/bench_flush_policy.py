@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Throughput and data-loss window of each EDF flush policy.
+
+For every `recording.FlushPolicy` tested, synthetic data records are
+written to an EDF file in the given directory twice: first as fast as
+possible, to measure throughput, and then at a fixed rate (as during an
+acquisition) to measure the worst-case time that a record waits before
+being flushed, i.e. how much data would be lost on a crash.
+
+    python3 benchmarks/bench_flush_policy.py --dir /media/sdcard
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+from edfrw import (EdfWriter, EdfHeader, EdfSignal)
+from recording import (EdfRecorder, FlushPolicy)
+
+POLICIES = (('records', 1), ('records', 10), ('seconds', 1),
+            ('seconds', 5), ('fsync', 1), ('fsync', 5))
+
+
+def make_recorder(path, nsignals, nsamples, policy):
+    signals = [EdfSignal(label='Signal {}'.format(n+1),
+                         sampling_freq=nsamples)
+               for n in range(nsignals)]
+    edffile = EdfWriter(os.path.join(path, 'bench.edf'),
+                        header=EdfHeader(signals=signals),
+                        saving_period_s=1)
+    return EdfRecorder(edffile, nsignals * nsamples, queue_size=64,
+                       policy=policy)
+
+
+def submit(recorder, record):
+    # Wait for space in the queue rather than dropping the record.
+    while recorder.queue_depth >= recorder.queue_size:
+        time.sleep(0.001)
+    return recorder.submit(record)
+
+
+def throughput(path, nsignals, nsamples, policy, nrecords):
+    recorder = make_recorder(path, nsignals, nsamples, policy)
+    record = np.zeros(nsignals * nsamples, dtype='<u2')
+    start = time.monotonic()
+    for n in range(nrecords):
+        record = submit(recorder, record)
+    recorder.close()
+    elapsed = time.monotonic() - start
+    return nrecords * record.nbytes / elapsed / 1e6
+
+
+def loss_window(path, nsignals, nsamples, policy, seconds, rate):
+    recorder = make_recorder(path, nsignals, nsamples, policy)
+    record = np.zeros(nsignals * nsamples, dtype='<u2')
+    start = time.monotonic()
+    for n in range(int(seconds * rate)):
+        delay = start + n / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        record = submit(recorder, record)
+    # Measure before closing, which flushes whatever is left. Records
+    # still waiting for a flush count as well: a policy that has not
+    # flushed yet is exposed for as long as its oldest record is old.
+    time.sleep(0.1)
+    window = max(recorder.max_flush_delay, recorder.unflushed_age)
+    flushes = recorder.flushes
+    recorder.close()
+    return window, flushes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--dir', type=str, default=None,
+                        help='directory where to write the test file')
+    parser.add_argument('--nsignals', type=int, default=8)
+    parser.add_argument('--nsamples', type=int, default=100,
+                        help='samples per signal in each data record')
+    parser.add_argument('--records', type=int, default=5000,
+                        help='records written in the throughput test')
+    parser.add_argument('--seconds', type=float, default=12,
+                        help='duration of the data-loss test')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='records per second in the data-loss test')
+    args = parser.parse_args()
+
+    tmpdir = None
+    path = args.dir
+    if path is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        path = tmpdir.name
+
+    print('{:<14}{:>10}{:>16}{:>10}'.format(
+            'policy', 'MB/s', 'max delay (s)', 'flushes'))
+    for (mode, every) in POLICIES:
+        policy = FlushPolicy(mode, every)
+        mbps = throughput(path, args.nsignals, args.nsamples, policy,
+                          args.records)
+        window, flushes = loss_window(path, args.nsignals,
+                                      args.nsamples, policy,
+                                      args.seconds, args.rate)
+        print('{:<14}{:>10.1f}{:>16.3f}{:>10}'.format(
+                '{} {}'.format(mode, every), mbps, window, flushes))
+
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Throughput of `framing.PacketFramer`.
+
+A synthetic stream of data packets is fed to the framer in chunks of
+fixed size, optionally with a fraction of the packets corrupted, and the
+framing throughput (MB/s of serial data) is reported.
+
+    python3 benchmarks/bench_framing.py --corrupt 0.01
+'''
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+from framing import PacketFramer
+
+
+def make_stream(npackets, nsamples, corrupt, seed=0):
+    rng = np.random.RandomState(seed)
+    samples = rng.randint(0, 4096, size=(npackets, nsamples))
+    packets = np.zeros((npackets, 4 + 2 * nsamples), dtype='uint8')
+    packets[:, :4] = 0xff
+    packets[:, 4:] = samples.astype('<u2').view('uint8')
+    stream = packets.ravel()
+    # Corrupt a few packets by dropping one byte from each.
+    ncorrupt = int(npackets * corrupt)
+    if ncorrupt:
+        drop = rng.choice(len(stream), ncorrupt, replace=False)
+        stream = np.delete(stream, drop)
+    return stream.tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--packets', type=int, default=50000)
+    parser.add_argument('--nsamples', type=int, default=60,
+                        help='samples per packet')
+    parser.add_argument('--corrupt', type=float, default=0,
+                        help='fraction of corrupted packets')
+    args = parser.parse_args()
+
+    stream = make_stream(args.packets, args.nsamples, args.corrupt)
+    print('{:>10}{:>10}{:>10}{:>10}'.format(
+            'chunk', 'MB/s', 'packets', 'resyncs'))
+    for chunk in (256, 4096, 65536):
+        framer = PacketFramer(args.nsamples, 1, capacity=1 + max(
+                2, 2 * chunk // (4 + 2 * args.nsamples)))
+        t0 = time.perf_counter()
+        for start in range(0, len(stream), chunk):
+            data = stream[start:start+chunk]
+            framer.feed(data[:framer.space])
+            framer.frame()
+        elapsed = time.perf_counter() - t0
+        print('{:>10}{:>10.1f}{:>10}{:>10}'.format(
+                chunk, len(stream) / elapsed / 1e6, framer.packets,
+                framer.resyncs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Rendering cost of the main window's live plot.
+
+`MainWindow` is run without a display (Qt's 'offscreen' platform) and
+fed by a simulated microcontroller (see `simulator.py`), as when the
+play button is clicked. For each number of signals given, once the
+display window has filled up, the following are measured:
+
+    setup_ms    Time taken by `MainWindow.setup_plot`.
+    update_ms   Percentiles of the time taken by `update_plot`.
+    paint_ms    Percentiles of the time taken to paint the plots.
+    frame_ms    Percentiles of update plus paint time per refresh.
+    dropped     Refreshes missed, i.e. timer periods
+                (`GUI_REFRESH_RATE`) in which the plot was not updated
+                because the previous refresh was still going on.
+
+    python3 benchmarks/bench_gui.py --signals 3 16 64 128 --rate 500
+
+Linux only (requires a pty).
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import platform
+import argparse
+import subprocess
+
+import numpy as np
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from PyQt5 import (QtCore, QtWidgets)
+import pyqtgraph as pg
+from edfrw import EdfSignal
+from mainwindow import MainWindow
+
+PERCENTILES = (50, 90, 99, 100)
+
+
+def percentiles(times):
+    times = np.asarray(times) * 1e3
+    return {'p{}'.format(p): (float(np.percentile(times, p))
+                              if len(times) else None)
+            for p in PERCENTILES}
+
+
+def start_simulator(nsignals):
+    simulator = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'simulator.py'),
+             '--nsignals', str(nsignals), '--baud', '0',
+             '--waveform', 'sine'],
+            stdout=subprocess.PIPE, universal_newlines=True)
+    # The simulator prints the name of its pseudo-terminal.
+    port = simulator.stdout.readline().split()[-1]
+    return simulator, port
+
+
+def run_event_loop(seconds):
+    loop = QtCore.QEventLoop()
+    QtCore.QTimer.singleShot(int(seconds * 1000), loop.quit)
+    loop.exec_()
+
+
+def run(nsignals, rate, refresh, warmup, seconds, size, process=False):
+    '''
+    Display *nsignals* in a new main window and return the measurements
+    as a dictionary.
+    '''
+    simulator, port = start_simulator(nsignals)
+
+    window = MainWindow()
+    window.GUI_REFRESH_RATE = refresh
+    window.resize(*size)
+    window.show()
+    if process:
+        from process_acquisition import ProcessAcquisition
+        window.daq = ProcessAcquisition()
+    window.daq.port = port
+    window.daq.config.sampling_freq = rate
+    window.daq.config.signals = [
+            EdfSignal(label='Signal {}'.format(n+1), sampling_freq=rate,
+                      physical_dim='uV')
+            for n in range(nsignals)]
+    # The simulated link is unlimited (``--baud 0``), as USB CDC.
+    window.daq.config.usb_cdc = True
+
+    update_times = []
+    update_starts = []
+    paint_times = []
+    update_plot = window.update_plot
+    setup_plot = window.setup_plot
+    setup_time = []
+
+    def timed_update_plot():
+        t0 = time.perf_counter()
+        update_plot()
+        update_starts.append(t0)
+        update_times.append(time.perf_counter() - t0)
+
+    def timed_setup_plot():
+        t0 = time.perf_counter()
+        setup_plot()
+        setup_time.append(time.perf_counter() - t0)
+
+    # `setup_plot` connects the refresh timer to `update_plot`, so the
+    # timed version must be in place beforehand.
+    window.update_plot = timed_update_plot
+    window.setup_plot = timed_setup_plot
+
+    paint_event = pg.GraphicsView.paintEvent
+
+    def timed_paint_event(view, event):
+        t0 = time.perf_counter()
+        paint_event(view, event)
+        if view is window.graphicsView:
+            paint_times.append(time.perf_counter() - t0)
+
+    pg.GraphicsView.paintEvent = timed_paint_event
+    try:
+        window.on_playButton_clicked(True)
+        # Let the display window fill up.
+        run_event_loop(warmup)
+        del update_times[:]
+        del update_starts[:]
+        del paint_times[:]
+        run_event_loop(seconds)
+    finally:
+        pg.GraphicsView.paintEvent = paint_event
+        window.on_stopButton_clicked(True)
+        window.close()
+        simulator.send_signal(signal.SIGINT)
+        simulator.wait()
+
+    # A refresh is dropped whenever the interval between two updates is
+    # longer than the timer period.
+    period = refresh / 1000
+    intervals = np.diff(update_starts)
+    dropped = int(np.sum(np.maximum(np.round(intervals / period) - 1, 0)))
+    nframes = min(len(update_times), len(paint_times))
+    frame_times = (np.array(update_times[:nframes]) +
+                   np.array(paint_times[:nframes]))
+    return {
+        'nsignals': nsignals,
+        'rate': rate,
+        'refresh_ms': refresh,
+        'setup_ms': setup_time[0] * 1e3 if setup_time else None,
+        'updates': len(update_times),
+        'paints': len(paint_times),
+        'update_ms': percentiles(update_times),
+        'paint_ms': percentiles(paint_times),
+        'frame_ms': percentiles(frame_times),
+        'dropped': dropped,
+        'expected': int(seconds / period),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--signals', type=int, nargs='+',
+                        default=[3, 16, 64, 128])
+    parser.add_argument('--rate', type=int, default=500,
+                        help='sampling frequency (Hz)')
+    parser.add_argument('--refresh', type=int,
+                        default=MainWindow.GUI_REFRESH_RATE,
+                        help='GUI refresh period (ms)')
+    parser.add_argument('--warmup', type=float, default=10,
+                        help='seconds before measuring; by default, '
+                             'the length of the display window')
+    parser.add_argument('--seconds', type=float, default=5,
+                        help='duration of each measurement')
+    parser.add_argument('--size', type=int, nargs=2, default=[1280, 800],
+                        help='window size (pixels)')
+    parser.add_argument('--process', action='store_true',
+                        help='acquire data in a separate process')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file where to save the results')
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication([])
+
+    print('{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+            'signals', 'setup ms', 'upd p50', 'paint p50', 'frame p50',
+            'frame p99', 'dropped'))
+    results = []
+    for nsignals in args.signals:
+        result = run(nsignals, args.rate, args.refresh, args.warmup,
+                     args.seconds, args.size, args.process)
+        results.append(result)
+        print('{:>8}{:>10.1f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'
+              '{:>6}/{:<4}'.format(
+                nsignals, result['setup_ms'] or 0,
+                result['update_ms']['p50'] or 0,
+                result['paint_ms']['p50'] or 0,
+                result['frame_ms']['p50'] or 0,
+                result['frame_ms']['p99'] or 0,
+                result['dropped'], result['expected']))
+
+    if args.output is not None:
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'qt_platform': app.platformName(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'size': args.size,
+            'process': args.process,
+            'results': results,
+            }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
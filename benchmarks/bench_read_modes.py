@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Latency and CPU cost of each `MCU` read mode.
+
+Data packets are written at a fixed rate to one end of a pseudo-terminal
+while an `MCU` connected to the other end waits for them as
+`DataAcquisition._read` does. For every read mode this reports the time
+from a packet being written to it being handed off (latency) and the CPU
+time used by the reader thread.
+
+    python3 benchmarks/bench_read_modes.py --seconds 5 --rate 50
+
+Linux only (requires a pty).
+'''
+
+import os
+import sys
+import time
+import threading
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+from acquisition import (MCU, READ_MODES)
+
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+def run(mode, seconds, rate, nbytes, poll_interval):
+    master, slave = os.openpty()
+    mcu = MCU(read_mode=mode)
+    mcu.poll_interval = poll_interval
+    mcu.connect(baud=115200, sampling_freq=100, port=os.ttyname(slave))
+
+    packet = b'\xff' * nbytes
+    sent = []
+
+    def write():
+        period = 1 / rate
+        t0 = time.monotonic()
+        for n in range(int(seconds * rate)):
+            delay = t0 + n * period - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            os.write(master, packet)
+            sent.append(time.monotonic())
+
+    writer = threading.Thread(target=write)
+    received = []
+    cpu = thread_time()
+    writer.start()
+    while len(received) < int(seconds * rate):
+        waiting = mcu.wait(nbytes, 0.5)
+        if waiting < nbytes:
+            if not writer.is_alive():
+                break
+            continue
+        npackets = waiting // nbytes
+        mcu.read(npackets * nbytes)
+        now = time.monotonic()
+        received.extend([now] * npackets)
+    cpu = thread_time() - cpu
+    writer.join()
+    mcu.serial.close()
+    os.close(master)
+    os.close(slave)
+
+    n = min(len(sent), len(received))
+    latency = (np.array(received[:n]) - np.array(sent[:n])) * 1000
+    return latency, cpu / seconds * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--rate', type=float, default=50,
+                        help='packets per second')
+    parser.add_argument('--nbytes', type=int, default=124,
+                        help='packet size in bytes')
+    args = parser.parse_args()
+
+    print('{:<14}{:>10}{:>10}{:>10}{:>8}'.format(
+            'mode', 'p50 ms', 'p99 ms', 'max ms', 'CPU %'))
+    runs = [(mode, MCU.poll_interval) for mode in READ_MODES]
+    runs.append(('poll', 0.01))
+    for (mode, interval) in runs:
+        latency, cpu = run(mode, args.seconds, args.rate, args.nbytes,
+                           interval)
+        name = mode if mode != 'poll' else 'poll {:g}s'.format(interval)
+        print('{:<14}{:>10.2f}{:>10.2f}{:>10.2f}{:>8.2f}'.format(
+                name, np.percentile(latency, 50),
+                np.percentile(latency, 99), latency.max(), cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """
+    Fixed-capacity, contiguous ring buffer of samples.
+
+    The buffer is a single preallocated array of shape
+    ``(capacity + slack,) + shape``; e.g. ``RingBuffer(1000, 3, 'uint16')``
+    holds the last 1000 rows of a 3-channel acquisition. New rows are
+    written with (at most two) vectorised slice assignments and the
+    contents can be read back as one or two views without copying.
+
+    capacity : :obj:`int`
+        Maximum number of rows kept in the buffer.
+    shape : :obj:`int` or :obj:`tuple`
+        Shape of each row. Defaults to ``()``, i.e. a 1-D buffer.
+    dtype : :obj:`numpy.dtype`
+        Data type of the buffer. Defaults to ``'uint16'``, the native
+        type of the samples sent by the microcontroller.
+    slack : :obj:`int`
+        Number of rows allocated beyond `capacity`. New rows overwrite
+        these first, so the last `capacity` rows remain intact while
+        the next `slack` rows are written.
+    buffer : buffer-like
+        Memory where the rows are kept, e.g. shared memory. By default,
+        a new array is allocated.
+
+    The buffer keeps count of the rows ever added to it (`count`). This
+    works as a sequence number: a reader that remembers the count at
+    the time of its last read knows whether there are new data, and can
+    get only these with `tail`.
+
+    One thread may add rows while others read them without locking,
+    as in a seqlock: `count` is only updated once new rows have been
+    written, and the rows about to be overwritten are announced
+    beforehand. A reader takes `count`, reads (copies) the rows it
+    needs, and then checks with `intact` that they were not overwritten
+    in the meantime; with enough `slack`, they never are.
+    """
+
+    def __init__(self, capacity, shape=(), dtype='uint16', slack=0,
+                 buffer=None):
+        if isinstance(shape, int):
+            shape = (shape,)
+        self.capacity = int(capacity)
+        self.slack = int(slack)
+        self._length = self.capacity + self.slack
+        if buffer is None:
+            self._data = np.zeros((self._length,) + tuple(shape),
+                                  dtype=dtype)
+        else:
+            self._data = np.ndarray((self._length,) + tuple(shape),
+                                    dtype=dtype, buffer=buffer)
+        # Number of rows added since the buffer was created or cleared.
+        # The position of the next row in `_data` is `count % _length`.
+        self.count = 0
+        # Number of rows added once the rows being written are done.
+        self._writing = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def shape(self):
+        '''
+        Shape of the valid contents of the buffer (read-only).
+        '''
+        return (len(self),) + self._data.shape[1:]
+
+    def clear(self):
+        self.count = 0
+        self._writing = 0
+
+    def extend(self, rows):
+        '''
+        Append *rows* to the buffer, discarding the oldest rows if the
+        buffer is full.
+        '''
+        rows = np.asarray(rows)
+        n = len(rows)
+        if n == 0:
+            return
+        count = self.count + n
+        # Only the last `_length` rows can be kept.
+        if n > self._length:
+            rows = rows[n-self._length:]
+            n = self._length
+        # Announce the rows that are about to be overwritten, write in
+        # one go or, if the end of the buffer is reached, in two slices
+        # that wrap around, and only then publish the new count.
+        self._writing = count
+        index = (count - n) % self._length
+        end = index + n
+        if end <= self._length:
+            self._data[index:end] = rows
+        else:
+            split = self._length - index
+            self._data[index:] = rows[:split]
+            self._data[:n-split] = rows[split:]
+        self.count = count
+
+    def tail(self, start, count=None):
+        '''
+        Return the rows from row number *start* (i.e. those added since
+        `count` was *start*) up to row number *count* (by default, the
+        current `count`), oldest first, as a tuple of one or two views
+        into the underlying array. Rows beyond the last `capacity` are
+        not returned.
+        '''
+        if count is None:
+            count = self.count
+        start = max(start, count - self.capacity)
+        if start >= count:
+            return (self._data[:0],)
+        index = start % self._length
+        end = index + count - start
+        if end <= self._length:
+            return (self._data[index:end],)
+        return (self._data[index:], self._data[:end-self._length])
+
+    def intact(self, start):
+        '''
+        Whether the rows from row number *start* onwards have not been
+        overwritten, nor are being overwritten. Check this after reading
+        the rows returned by `tail` while rows may be being added.
+        '''
+        return self._writing - start <= self._length
+
+    def views(self):
+        '''
+        Return the contents of the buffer, oldest rows first, as a tuple
+        of one or two views into the underlying array. No data are
+        copied.
+        '''
+        return self.tail(0)
+
+    def get(self):
+        '''
+        Return the contents of the buffer, oldest rows first, as a
+        single contiguous array. This is a view if the contents do not
+        wrap around the end of the underlying array and a copy
+        otherwise.
+        '''
+        views = self.views()
+        if len(views) == 1:
+            return views[0]
+        return np.concatenate(views)
+
+
+class RecordBuffer(object):
+    """
+    Preallocated buffer for EDF data records.
+
+    EDF data records are channel-major: all the samples of the first
+    signal acquired during the record, then all those of the second
+    signal, and so on. Samples (rows of samples x signals, as read from
+    the microcontroller) are scattered into a preallocated record with
+    strided slice assignments, and every time the record is complete
+    `callback` is called with it.
+
+    If the signals have different sampling frequencies, and thus
+    different numbers of samples per record, the samples of each signal
+    are added separately with `extend_channels`.
+
+    nsamples : :obj:`list` of :obj:`int`
+        Number of samples of each signal in one data record.
+    callback : callable
+        Called as ``callback(record)`` every time a data record is
+        complete, `record` being a 1-D array. The callback may return a
+        new array (of the same size and type) to be used for the next
+        record, thus handing over ownership of `record`; if it returns
+        None, `record` will be overwritten once the callback returns.
+    dtype : :obj:`numpy.dtype`
+        Data type of the samples. Defaults to little-endian uint16.
+    """
+
+    def __init__(self, nsamples, callback, dtype='<u2'):
+        self.nsamples = [int(n) for n in nsamples]
+        self.nsignals = len(self.nsamples)
+        self.uniform = len(set(self.nsamples)) == 1
+        self.length = self.nsamples[0]
+        self.callback = callback
+        self.size = sum(self.nsamples)
+        self._set_record(np.zeros(self.size, dtype=dtype))
+        self._index = 0
+        # Number of samples of each signal in the current data record
+        # (`extend_channels`).
+        self._indices = [0] * self.nsignals
+
+    def _set_record(self, record):
+        self.record = record
+        # The block of each signal in the record.
+        self._blocks = np.split(record, np.cumsum(self.nsamples)[:-1])
+        # A (signals x samples) view of the record. Writing the
+        # transpose of the incoming rows into it places each signal's
+        # samples in its own contiguous block.
+        if self.uniform:
+            self._channels = record.reshape(self.nsignals, self.length)
+
+    def __len__(self):
+        '''
+        Number of samples (per signal) in the current, incomplete data
+        record.
+        '''
+        return self._index
+
+    def clear(self):
+        self._index = 0
+        self._indices = [0] * self.nsignals
+
+    def _complete(self):
+        # Hand over the complete data record.
+        record = self.callback(self.record)
+        if record is not None:
+            self._set_record(record)
+
+    def extend(self, samples):
+        '''
+        Add *samples*, a 2-D array of samples x signals, to the data
+        record, calling `callback` every time this is complete. All
+        signals must have the same number of samples per record.
+        '''
+        if not self.uniform:
+            raise ValueError('Signals have different numbers of samples '
+                             'per data record; use extend_channels')
+        start = 0
+        nrows = len(samples)
+        while start < nrows:
+            count = min(nrows - start, self.length - self._index)
+            end = self._index + count
+            self._channels[:, self._index:end] = \
+                samples[start:start+count].T
+            self._index = end
+            start += count
+            if self._index == self.length:
+                self._complete()
+                self._index = 0
+
+    def extend_channels(self, channels):
+        '''
+        Add the samples of each signal, *channels* being a list of 1-D
+        arrays (one per signal) that cover the same period of time, to
+        the data record, calling `callback` every time this is
+        complete.
+        '''
+        positions = [0] * self.nsignals
+        while True:
+            for (n, channel) in enumerate(channels):
+                index = self._indices[n]
+                count = min(len(channel) - positions[n],
+                            self.nsamples[n] - index)
+                self._blocks[n][index:index+count] = \
+                    channel[positions[n]:positions[n]+count]
+                self._indices[n] = index + count
+                positions[n] += count
+            if self._indices != self.nsamples:
+                # Either all the samples have been added or, if the
+                # signals do not cover the same time, those of some
+                # signals are left over; they cannot be placed.
+                break
+            self._complete()
+            self._indices = [0] * self.nsignals
@@ -23,10 +23,16 @@ Signals: Describes each of the signals (or channels) that are to be
 '''
 
 import os
+import math
 import configparser
+from fractions import Fraction
 from collections import OrderedDict
+import numpy as np
 from edfrw import (EdfSubjectId, EdfRecordingId, EdfSignal)
 
+from framing import sampling_dividers
+import protocol
+
 # Arduino baud rates, according to https://www.arduino.cc/en/Serial
 # /Begin: 300, 600, 1200, 2400, 4800, 9600, 14400, 19200, 28800, 38400,
 # 57600, 115200
@@ -36,7 +42,25 @@ from edfrw import (EdfSubjectId, EdfRecordingId, EdfSignal)
 # https://developer.mbed.org/forum/mbed/topic/893/?page=1#comment-4526)
 #
 # It makes sense to only allow some of these.
-BAUD_RATES = (115200, 57600, 38400, 19200, 14400, 9600)
+BAUD_RATES = (921600, 460800, 230400, 115200, 57600, 38400, 19200, 14400,
+              9600)
+
+# Bits sent over the serial line for each byte: start bit, 8 data bits
+# and stop bit (8N1).
+BITS_PER_BYTE = 10
+
+# Throughput (bytes/s) assumed for USB CDC devices, which ignore the
+# baud rate. This is a conservative figure for full-speed USB bulk
+# transfers.
+USB_CDC_BYTES_PER_S = 1000000
+
+# Highest sampling frequency (Hz) that can be configured. Above 999 Hz,
+# the microcontroller must support protocol version 2 (see `protocol`).
+MAX_SAMPLING_FREQ = 50000
+
+# Maximum size in bytes of an EDF data record, as recommended by the
+# EDF specification.
+MAX_RECORD_BYTES = 61440
 
 
 class Configuration(object):
@@ -46,22 +70,40 @@ class Configuration(object):
     baud : :obj:`uint`
         Baud rate for communicating with the MCU.
     sampling_freq :  :obj:`uint`
-        Sampling frequency in Hz.
+        Base sampling frequency in Hz. Each signal is sampled at this
+        frequency or at an exact divisor of it (its own
+        `sampling_freq`).
     working_dir : :obj:`str`
         Directory where data files will be saved. Defaults to ``'.'``.
     signals : :obj:`list` of :obj:`edfrw.EdfSignal`
         List of signals to acquire. The contents must match those
         signals expected from the MCU.
     saving_period_s : :obj:`int`
-        How often (seconds) are data samples saved to disk. Defaults
-        to 5 seconds.
+        How often (seconds) are data samples saved to disk, i.e. the
+        duration of each EDF data record. Defaults to 5 seconds. This
+        is shortened if needed (see `record_duration`).
+    usb_cdc : :obj:`bool`
+        Whether the MCU is a USB CDC device, whose throughput does not
+        depend on the baud rate (see `link_capacity`).
+    encoding : :obj:`str`
+        Sample encoding requested from the MCU (see `encoding`).
+    max_baud : :obj:`uint`
+        Highest baud rate that `plan_baud` may select (see `max_baud`).
     """
     def __init__(self, baud=115200, sampling_freq=100, data_path='.',
-                 saving_period_s=5, signals=[]):
+                 saving_period_s=5, signals=[], usb_cdc=False,
+                 encoding='u16', max_baud=115200):
+        # Signal ranges for which the conversion from digital to
+        # physical values was last computed (see `conversion`).
+        self._conversion_key = None
+
         self.baud = baud
         self.sampling_freq = sampling_freq
         self.data_path = data_path
         self.saving_period_s = saving_period_s
+        self.usb_cdc = usb_cdc
+        self.encoding = encoding
+        self.max_baud = max_baud
 
         self.subject_id = EdfSubjectId()
         self.recording_id = EdfRecordingId()
@@ -69,11 +111,11 @@ class Configuration(object):
         if len(signals) == 0:
             signals = [EdfSignal(label = 'Signal ' + str(n+1))
                             for n in range(3)]
-        # Each signal must have sampling frequency defined. Pydaq in its
-        # current form acquires all signals at the same rate but EDF
-        # allows for different sampling rates.
+        # Each signal must have sampling frequency defined. Those that
+        # have none are sampled at the base frequency.
         for signal in signals:
-            signal.sampling_freq = self.sampling_freq
+            if not signal.sampling_freq:
+                signal.sampling_freq = self.sampling_freq
         self.signals = signals
 
         config_dir = os.path.join(os.environ['HOME'], '.config')
@@ -82,7 +124,12 @@ class Configuration(object):
                                          '.pydaq.ini')
         else:
             self._config_f = os.path.join(config_dir, 'pydaq.ini')
-        self.load(self._config_f)
+        try:
+            self.load(self._config_f)
+        except ValueError as error:
+            # The default configuration is loaded on start; leave it to
+            # be corrected rather than failing to start.
+            print('Configuration {}: {}'.format(self._config_f, error))
 
     @property
     def baud(self):
@@ -99,6 +146,81 @@ class Configuration(object):
         else:
             self._baud = value
 
+    @property
+    def max_baud(self):
+        '''
+        Highest baud rate that `plan_baud` may select. The firmware runs
+        at the fixed rate defined by `BAUD` in its source (115200 by
+        default), which `baud` must match; a different rate requires
+        rebuilding the firmware. Raise this only for firmware built for
+        a higher rate.
+        '''
+        return self._max_baud
+
+    @max_baud.setter
+    def max_baud(self, value):
+        if value not in BAUD_RATES:
+            raise ValueError(
+                    'Baud rate {} is not supported'.format(value))
+        self._max_baud = value
+
+    @property
+    def sampling_freq(self):
+        '''
+        Base sampling frequency in Hz.
+
+        Signals sampled at the base frequency follow it when it is
+        changed; those sampled at a lower frequency keep theirs.
+        '''
+        return self._sampling_freq
+
+    @sampling_freq.setter
+    def sampling_freq(self, value):
+        previous = getattr(self, '_sampling_freq', None)
+        for signal in getattr(self, 'signals', []):
+            if signal.sampling_freq in (previous, 0):
+                signal.sampling_freq = value
+        self._sampling_freq = value
+
+    @property
+    def dividers(self):
+        '''
+        Number of ticks of the base sampling frequency between two
+        samples of each signal (read-only). Raises ValueError if the
+        sampling frequency of a signal is not an exact divisor of the
+        base frequency, or if the microcontroller cannot send a whole
+        cycle of the dividers in a data packet (see
+        `protocol.cycle_samples`).
+        '''
+        dividers = []
+        for signal in self.signals:
+            try:
+                dividers += sampling_dividers(self.sampling_freq,
+                                              [signal.sampling_freq])
+            except ValueError as error:
+                raise ValueError('{}: {}'.format(signal.label, error))
+        (cycle, per_cycle) = protocol.cycle_samples(dividers)
+        if (per_cycle > protocol.BUFFER_SAMPLES or
+                cycle > protocol.MAX_CYCLE):
+            raise ValueError(
+                    'The sampling pattern of the signals repeats every {} '
+                    'ticks ({} samples), but a data packet of the '
+                    'microcontroller holds up to {} samples and {} ticks; '
+                    'use fewer signals, or sampling frequencies that are '
+                    'divisors of one another'.format(
+                            cycle, per_cycle, protocol.BUFFER_SAMPLES,
+                            protocol.MAX_CYCLE))
+        return dividers
+
+    @property
+    def multirate(self):
+        '''
+        Whether some signals are sampled at a lower frequency than the
+        base sampling frequency (read-only).
+        '''
+        return any(signal.sampling_freq != self.sampling_freq
+                   for signal in self.signals)
+
     @property
     def data_path(self):
         '''
@@ -143,9 +265,192 @@ class Configuration(object):
         # Ensure that the saving period is an integer
         self._saving_period_s = int(val)
 
+    @property
+    def record_duration(self):
+        '''
+        Duration in seconds of each EDF data record (read-only).
+
+        This is the largest duration, up to `saving_period_s`, such
+        that a data record does not exceed `MAX_RECORD_BYTES` and holds
+        a whole number of samples of every signal. It may be less than
+        a second if many signals are sampled at high frequencies. (Short
+        records do not mean small writes: the recorder writes records
+        in chunks, see `recording.FlushPolicy`.) The duration is written
+        in the EDF header as a decimal number of up to 8 characters, so
+        only durations that can be written exactly are considered.
+
+        Raises ValueError if there is no such duration: either the
+        signals produce too much data for valid EDF data records, or no
+        duration short enough holds a whole number of samples of every
+        signal and can also be written exactly (e.g. 64 signals at
+        997 Hz).
+        '''
+        freqs = [int(signal.sampling_freq) for signal in self.signals]
+        bytes_per_s = 2 * sum(freqs)
+        # Durations that hold a whole number of samples of every signal
+        # are the multiples of `step`.
+        step = Fraction(1, 1)
+        if freqs and min(freqs) > 0:
+            gcd = 0
+            for freq in freqs:
+                gcd = math.gcd(gcd, freq)
+            step = Fraction(1, gcd)
+        longest = Fraction(self.saving_period_s)
+        if bytes_per_s:
+            longest = min(longest, Fraction(MAX_RECORD_BYTES, bytes_per_s))
+        if longest < step:
+            raise ValueError(
+                    'The signals ({} bytes/s) do not fit in EDF data '
+                    'records of up to {} bytes; reduce the number of '
+                    'signals or their sampling frequency'.format(
+                            bytes_per_s, MAX_RECORD_BYTES))
+        for multiple in range(int(longest / step), 0, -1):
+            duration = multiple * step
+            if self._valid_duration(duration, freqs):
+                return float(duration)
+        raise ValueError(
+                'No EDF data record duration of up to {:.3g} s holds a '
+                'whole number of samples of every signal and can be '
+                'written exactly in the 8-character header field; use '
+                'sampling frequencies that divide into a round number '
+                '(e.g. multiples of 10 Hz)'.format(float(longest)))
+
+    @staticmethod
+    def _valid_duration(duration, freqs):
+        # Whether `duration` (a Fraction) can be written in the EDF
+        # header exactly, and gives a whole number of samples of every
+        # signal when multiplied as a float (as done by EdfWriter).
+        text = str(float(duration))
+        if len(text) > 8 or Fraction(text) != duration:
+            return False
+        return all(int(freq * float(duration)) == freq * duration
+                   for freq in freqs)
+
+    @property
+    def encoding(self):
+        '''
+        Sample encoding requested from the MCU (see
+        `protocol.ENCODINGS`). With 'p12', 12-bit samples are packed two
+        in three bytes, if the MCU supports it.
+        '''
+        return self._encoding
+
+    @encoding.setter
+    def encoding(self, value):
+        if value not in protocol.ENCODINGS:
+            raise ValueError(
+                    'Sample encoding {} is not supported'.format(value))
+        self._encoding = value
+
+    @property
+    def link_bytes_per_s(self):
+        '''
+        Bytes per second sent by the MCU (read-only): the samples of
+        all signals, with the requested `encoding`, plus the header of
+        each data packet. Raises ValueError if the sampling frequencies
+        of the signals are not valid (see `dividers`).
+        '''
+        return protocol.data_rate(self.sampling_freq, self.dividers,
+                                  self.encoding)
+
+    def link_capacity(self, baud=None):
+        '''
+        Bytes per second that the link to the MCU can carry at *baud*
+        (by default, `baud`). This does not depend on the baud rate for
+        USB CDC devices.
+        '''
+        if self.usb_cdc:
+            return USB_CDC_BYTES_PER_S
+        if baud is None:
+            baud = self.baud
+        return baud / BITS_PER_BYTE
+
+    def link_headroom(self, baud=None):
+        '''
+        Fraction of the link capacity at *baud* (by default, `baud`)
+        that is left unused. Negative if the data would overrun the
+        link.
+        '''
+        return 1 - self.link_bytes_per_s / self.link_capacity(baud)
+
+    def plan_baud(self):
+        '''
+        Return the lowest baud rate in `BAUD_RATES`, up to `max_baud`,
+        that can carry the data. Raises ValueError if there is none.
+        '''
+        for baud in sorted(BAUD_RATES):
+            if baud <= self.max_baud and self.link_headroom(baud) >= 0:
+                return baud
+        if self.link_headroom(max(BAUD_RATES)) >= 0:
+            raise ValueError(
+                    'The signals ({:.0f} bytes/s) overrun the serial link '
+                    'at up to {} baud, the highest rate allowed for the '
+                    'firmware (max_baud); rebuild the firmware for a '
+                    'higher rate and raise max_baud, or reduce the number '
+                    'of signals or their sampling frequency'.format(
+                            self.link_bytes_per_s, self.max_baud))
+        raise ValueError(
+                'The signals ({:.0f} bytes/s) overrun the serial link at '
+                'any baud rate; reduce the number of signals or their '
+                'sampling frequency'.format(self.link_bytes_per_s))
+
+    def check_link(self):
+        '''
+        Raise ValueError if the data would overrun the link to the MCU
+        at the configured baud rate.
+        '''
+        if self.link_headroom() >= 0:
+            return
+        baud = self.plan_baud()
+        raise ValueError(
+                'The signals ({:.0f} bytes/s) overrun the serial link at '
+                '{} baud; use {} baud or higher'.format(
+                        self.link_bytes_per_s, self.baud, baud))
+
+    def conversion(self):
+        '''
+        Return the gain and offset of every signal as two 1-D arrays,
+        such that the physical values of the digital samples `s` of all
+        signals (samples x signals) are ``gain * (s + offset)``. This is
+        the same conversion as `edfrw.EdfSignal.dig_to_phys`.
+
+        The arrays are computed again only if the physical or digital
+        range of any signal, or the signals themselves, have changed.
+        '''
+        key = tuple((signal.physical_min, signal.physical_max,
+                     signal.digital_min, signal.digital_max)
+                    for signal in self.signals)
+        if key != self._conversion_key:
+            self._gain = np.array([signal.gain for signal in self.signals])
+            self._offset = np.array(
+                    [signal.physical_max / signal.gain - signal.digital_max
+                     for signal in self.signals])
+            self._conversion_key = key
+        return self._gain, self._offset
+
+    def dig_to_phys(self, samples):
+        '''
+        Convert *samples* (samples x signals) from digital to physical
+        values, all signals at once.
+        '''
+        gain, offset = self.conversion()
+        samples = np.asarray(samples)
+        # As in EdfSignal.dig_to_phys, digital values are signed 16-bit
+        # integers.
+        if samples.dtype == np.uint16:
+            samples = samples.view(np.int16)
+        phys = np.add(samples, offset)
+        phys *= gain
+        return phys
+
     def load(self, config_f):
         '''
         Load configuration from file *config_f*.
+
+        Raises ValueError if the signals cannot be acquired (see
+        `dividers`) or recorded (see `record_duration`). The
+        configuration is loaded nonetheless, so that it can be
+        corrected.
         '''
         config = configparser.ConfigParser(empty_lines_in_values=False)
         config.read(config_f)
@@ -162,6 +467,9 @@ class Configuration(object):
             self.data_path = main.get('data_path', self.data_path)
             self.saving_period_s = main.getint('saving_period_s',
                                                self.saving_period_s)
+            self.usb_cdc = main.getboolean('usb_cdc', self.usb_cdc)
+            self.encoding = main.get('encoding', self.encoding)
+            self.max_baud = main.getint('max_baud', self.max_baud)
 
         if 'Subject' in config.sections():
             subject = config['Subject']
@@ -196,7 +504,13 @@ class Configuration(object):
                         digital_min =  sig.getint('digital_min', -32768),
                         digital_max = sig.getint('digital_max', 32767),
                         prefiltering = sig.get('prefiltering', ''),
-                        sampling_freq = self.sampling_freq))
+                        sampling_freq = sig.getint('sampling_freq',
+                                                   self.sampling_freq)))
+
+        # Check that the microcontroller can send the signals and that
+        # the data records can be written.
+        self.dividers
+        self.record_duration
 
     def save(self, config_f=None):
         main_dict = OrderedDict([
@@ -204,6 +518,9 @@ class Configuration(object):
                 ('sampling_freq', self.sampling_freq),
                 ('data_path', self.data_path),
                 ('saving_period_s', self.saving_period_s),
+                ('usb_cdc', 'yes' if self.usb_cdc else 'no'),
+                ('encoding', self.encoding),
+                ('max_baud', self.max_baud),
                 ])
 
         subject_dict = OrderedDict([
@@ -236,6 +553,7 @@ class Configuration(object):
                     ('digital_min', signal.digital_min),
                     ('digital_max', signal.digital_max),
                     ('prefiltering', signal.prefiltering),
+                    ('sampling_freq', signal.sampling_freq),
                     ])
             config_dict[section] = section_contents
 
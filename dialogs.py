@@ -25,14 +25,16 @@ from PyQt5 import (QtCore, QtGui, QtWidgets)
 from edfrw import EdfSignal
 from ui.ui_configuration_dialog import Ui_ConfigurationDialog
 from ui.ui_signal_dialog import Ui_SignalDialog
-from configuration import BAUD_RATES
+from configuration import (BAUD_RATES, MAX_SAMPLING_FREQ)
 
-MAIN_NROWS = 4
-(BAUD, SAMPLING_FREQ, DATA_PATH, SAVING_PERIOD) = range(MAIN_NROWS)
+MAIN_NROWS = 6
+(BAUD, SAMPLING_FREQ, DATA_PATH, SAVING_PERIOD, USB_CDC,
+ PACKED) = range(MAIN_NROWS)
 
-SIGNAL_NCOLS = 8
+SIGNAL_NCOLS = 9
 (LABEL, TRANSDUCER_TYPE, PHYSICAL_DIM, PHYSICAL_MIN, PHYSICAL_MAX,
- DIGITAL_MIN, DIGITAL_MAX, PREFILTERING) = range(SIGNAL_NCOLS)
+ DIGITAL_MIN, DIGITAL_MAX, PREFILTERING,
+ SIGNAL_SAMPLING_FREQ) = range(SIGNAL_NCOLS)
 
 SUBJECT_NROWS = 4
 (CODE, SEX, DOB, NAME) = range(SUBJECT_NROWS)
@@ -46,6 +48,16 @@ class SignalDialog(QtWidgets.QDialog, Ui_SignalDialog):
     def __init__(self, parent=None):
         QtWidgets.QDialog.__init__(self, parent)
         self.setupUi(self)
+        # Sampling frequency of the signal, below the prefiltering and
+        # above the buttons.
+        self.gridLayout.removeWidget(self.buttonBox)
+        self.gridLayout.addWidget(self.buttonBox, 9, 1, 1, 2)
+        self.samplFreqLabel = QtWidgets.QLabel('Sampling frequency (Hz)',
+                                               self)
+        self.samplFreqSpinBox = QtWidgets.QSpinBox(self)
+        self.samplFreqSpinBox.setRange(1, MAX_SAMPLING_FREQ)
+        self.gridLayout.addWidget(self.samplFreqLabel, 8, 0, 1, 2)
+        self.gridLayout.addWidget(self.samplFreqSpinBox, 8, 2, 1, 1)
 
 
 class ConfigurationDialog(QtWidgets.QDialog, Ui_ConfigurationDialog):
@@ -59,6 +71,29 @@ class ConfigurationDialog(QtWidgets.QDialog, Ui_ConfigurationDialog):
         self.baudComboBox.setModel(baud_model)
         sex_model = QtCore.QStringListModel(['F', 'M', 'X'], self)
         self.sexComboBox.setModel(sex_model)
+        self.samplFreqSpinBox.setMaximum(MAX_SAMPLING_FREQ)
+
+        # Link budget, below the sampling interval: whether the data
+        # fit in the serial link at the selected baud rate.
+        self.planBaudPushButton = QtWidgets.QPushButton('Lowest',
+                                                        self.groupBox_2)
+        self.planBaudPushButton.setToolTip(
+                'Select the lowest baud rate, up to the maximum allowed for '
+                'the firmware, that can carry the data')
+        self.usbCdcCheckBox = QtWidgets.QCheckBox(
+                'USB CDC device (baud rate ignored)', self.groupBox_2)
+        self.packedCheckBox = QtWidgets.QCheckBox(
+                'Packed 12-bit samples', self.groupBox_2)
+        self.packedCheckBox.setToolTip(
+                'Send two samples in three bytes, if the microcontroller '
+                'supports it')
+        self.linkLabel = QtWidgets.QLabel('Link headroom', self.groupBox_2)
+        self.linkHeadroomLabel = QtWidgets.QLabel(self.groupBox_2)
+        self.gridLayout_2.addWidget(self.planBaudPushButton, 0, 2, 1, 1)
+        self.gridLayout_2.addWidget(self.usbCdcCheckBox, 3, 0, 1, 3)
+        self.gridLayout_2.addWidget(self.packedCheckBox, 4, 0, 1, 3)
+        self.gridLayout_2.addWidget(self.linkLabel, 5, 0, 1, 1)
+        self.gridLayout_2.addWidget(self.linkHeadroomLabel, 5, 1, 1, 2)
 
         self.config = config
 
@@ -70,11 +105,26 @@ class ConfigurationDialog(QtWidgets.QDialog, Ui_ConfigurationDialog):
         mapper.addMapping(self.samplFreqSpinBox, SAMPLING_FREQ)
         mapper.addMapping(self.pathLineEdit, DATA_PATH)
         mapper.addMapping(self.flushSecondsSpinBox, SAVING_PERIOD)
+        mapper.addMapping(self.usbCdcCheckBox, USB_CDC)
+        mapper.addMapping(self.packedCheckBox, PACKED)
         mapper.toFirst()
+        self.main_mapper = mapper
 
-        self.signals_model = SignalModel(self.config.signals)
+        self.signals_model = SignalModel(self.config)
         self.tableView.setModel(self.signals_model)
 
+        # Update the link budget whenever the data or the link change.
+        self.baudComboBox.currentIndexChanged.connect(self.on_link_changed)
+        self.samplFreqSpinBox.valueChanged.connect(self.on_link_changed)
+        self.usbCdcCheckBox.toggled.connect(self.on_link_changed)
+        self.packedCheckBox.toggled.connect(self.on_link_changed)
+        self.planBaudPushButton.clicked.connect(self.plan_baud)
+        for signal in (self.signals_model.dataChanged,
+                       self.signals_model.rowsInserted,
+                       self.signals_model.rowsRemoved):
+            signal.connect(self.update_link_headroom)
+        self.update_link_headroom()
+
         subject_model = SubjectIdModel(self.config.subject_id)
         mapper = QtWidgets.QDataWidgetMapper(self)
         mapper.setOrientation(QtCore.Qt.Vertical)
@@ -110,6 +160,7 @@ class ConfigurationDialog(QtWidgets.QDialog, Ui_ConfigurationDialog):
         mapper.addMapping(dialog.digitalMinLineEdit, DIGITAL_MIN)
         mapper.addMapping(dialog.digitalMaxLineEdit, DIGITAL_MAX)
         mapper.addMapping(dialog.prefilteringTextEdit, PREFILTERING)
+        mapper.addMapping(dialog.samplFreqSpinBox, SIGNAL_SAMPLING_FREQ)
 
         mapper.setCurrentIndex(row)
 
@@ -136,6 +187,52 @@ class ConfigurationDialog(QtWidgets.QDialog, Ui_ConfigurationDialog):
         txt = '{:.3f}'.format(interval)
         self.samplIntervalLabel.setText(txt)
 
+    def on_link_changed(self, *args):
+        # Commit the main settings so that the link budget uses them.
+        self.main_mapper.submit()
+        self.update_link_headroom()
+
+    def update_link_headroom(self, *args):
+        try:
+            required = self.config.link_bytes_per_s
+        except ValueError:
+            # The sampling frequencies of the signals are not valid.
+            self.linkHeadroomLabel.setText('-')
+            return
+        capacity = self.config.link_capacity()
+        headroom = self.config.link_headroom()
+        if headroom < 0:
+            txt = 'Overrun: {:.0f} bytes/s, link carries {:.0f}'
+            self.linkHeadroomLabel.setStyleSheet('color: red')
+        else:
+            txt = '{2:.0%} ({0:.0f} of {1:.0f} bytes/s)'
+            self.linkHeadroomLabel.setStyleSheet('')
+        self.linkHeadroomLabel.setText(txt.format(required, capacity,
+                                                  headroom))
+        self.planBaudPushButton.setEnabled(not self.config.usb_cdc)
+
+    def plan_baud(self):
+        try:
+            baud = self.config.plan_baud()
+        except ValueError as error:
+            QtWidgets.QMessageBox.warning(self, 'Link overrun',
+                                          error.args[0])
+            return
+        self.baudComboBox.setCurrentIndex(
+                self.baudComboBox.findText(str(baud)))
+
+    def accept(self):
+        # Do not close the dialog with signals that cannot be acquired
+        # or recorded.
+        try:
+            self.config.dividers
+            self.config.record_duration
+        except ValueError as error:
+            QtWidgets.QMessageBox.warning(self, 'Configuration error',
+                                          error.args[0])
+            return
+        QtWidgets.QDialog.accept(self)
+
     def on_addSignalPushButton_clicked(self, checked=None):
         if checked is None:
             return
@@ -170,6 +267,10 @@ class MainConfigModel(QtCore.QAbstractListModel):
                 return QtCore.QVariant(self.config.data_path)
             elif row == SAVING_PERIOD:
                 return QtCore.QVariant(self.config.saving_period_s)
+            elif row == USB_CDC:
+                return QtCore.QVariant(self.config.usb_cdc)
+            elif row == PACKED:
+                return QtCore.QVariant(self.config.encoding == 'p12')
         else:
             return QtCore.QVariant()
 
@@ -184,6 +285,10 @@ class MainConfigModel(QtCore.QAbstractListModel):
                 self.config.data_path = value
             elif row == SAVING_PERIOD:
                 self.config.saving_period_s = value
+            elif row == USB_CDC:
+                self.config.usb_cdc = bool(value)
+            elif row == PACKED:
+                self.config.encoding = 'p12' if value else 'u16'
             self.dataChanged.emit(index, index, [])
             return True
         else:
@@ -207,11 +312,13 @@ class SignalModel(QtCore.QAbstractTableModel):
                'Physical max',
                'Digital min',
                'Digital max',
-               'Prefiltering')
+               'Prefiltering',
+               'Sampling freq')
 
-    def __init__(self, signals):
+    def __init__(self, config):
         super(QtCore.QAbstractTableModel, self).__init__()
-        self.signals = signals
+        self.config = config
+        self.signals = config.signals
 
     def rowCount(self, index=QtCore.QModelIndex()):
         return len(self.signals)
@@ -244,6 +351,8 @@ class SignalModel(QtCore.QAbstractTableModel):
                 return QtCore.QVariant(signal.digital_max)
             elif column == PREFILTERING:
                 return QtCore.QVariant(signal.prefiltering)
+            elif column == SIGNAL_SAMPLING_FREQ:
+                return QtCore.QVariant(signal.sampling_freq)
 
         elif role == QtCore.Qt.TextAlignmentRole:
             return QtCore.QVariant(
@@ -306,6 +415,18 @@ class SignalModel(QtCore.QAbstractTableModel):
                 signal.digital_max = value
             elif column == PREFILTERING:
                 signal.prefiltering = value
+            elif column == SIGNAL_SAMPLING_FREQ:
+                # Signals are sampled at the base sampling frequency or
+                # at a divisor of it.
+                base_freq = self.config.sampling_freq
+                if value < 1 or base_freq % value:
+                    QtWidgets.QMessageBox.warning(
+                            None, "Invalid sampling frequency",
+                            "The sampling frequency of a signal must be "
+                            "a divisor of the sampling frequency "
+                            "({} Hz).".format(base_freq))
+                    return False
+                signal.sampling_freq = value
             return True
 
         else:
@@ -316,7 +437,7 @@ class SignalModel(QtCore.QAbstractTableModel):
                              position + rows - 1)
         n = len(self.signals) + 1
         new_signal = EdfSignal(label='Signal {}'.format(n))
-        new_signal.sampling_freq = self.data
+        new_signal.sampling_freq = self.config.sampling_freq
         self.signals.append(new_signal)
         self.endInsertRows()
         return True
@@ -0,0 +1,177 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Data reduction for display.
+
+A plot cannot show more detail than one value range per pixel column,
+so there is no point in drawing more than two points (the minimum and
+the maximum) per column. Keeping both, rather than e.g. every n-th
+sample, ensures that short spikes remain visible.
+'''
+
+import numpy as np
+
+from buffers import RingBuffer
+
+
+def _minmax(y, step):
+    # Replace each bin of *step* samples of *y* (whose length must be a
+    # multiple of *step*) with its minimum and maximum values.
+    nbins = len(y) // step
+    bins = y.reshape((nbins, step) + y.shape[1:])
+    y_out = np.empty((2*nbins,) + y.shape[1:], dtype=y.dtype)
+    np.min(bins, axis=1, out=y_out[0::2])
+    np.max(bins, axis=1, out=y_out[1::2])
+    return y_out
+
+
+def _minmax_bins(x, y, step):
+    # As `_minmax`, also taking the times *x* of the first and last
+    # samples of each bin.
+    nbins = len(y) // step
+    y_out = _minmax(y, step)
+    x_out = np.empty(2*nbins, dtype=x.dtype)
+    x_out[0::2] = x[0::step]
+    x_out[1::2] = x[step-1::step]
+    return x_out, y_out
+
+
+def minmax_decimate(x, y, width):
+    '''
+    Reduce the samples *y* (samples x signals, or 1-D) taken at times
+    *x* to at most about two points per pixel column of a plot *width*
+    pixels wide. All signals are processed at once.
+
+    The samples are split into consecutive bins of equal size and each
+    bin is replaced by its minimum and maximum values, in that order,
+    at the times of the first and last samples of the bin. Samples that
+    do not fill a whole bin (at most one bin's worth, at the end) are
+    kept as they are. If there are fewer than two samples per pixel
+    column the data are returned unchanged.
+
+    Returns the decimated *x* and *y*.
+    '''
+    nsamples = len(y)
+    width = max(int(width), 1)
+    if nsamples <= 2 * width:
+        return x, y
+    # Samples per bin, so that there are no more than `width` bins.
+    step = -(-nsamples // width)
+    end = (nsamples // step) * step
+    x_bins, y_bins = _minmax_bins(x[:end], y[:end], step)
+    return (np.concatenate((x_bins, x[end:])),
+            np.concatenate((y_bins, y[end:])))
+
+
+class MinMaxDecimator(object):
+    """
+    Incremental version of `minmax_decimate` for a continuous stream of
+    samples.
+
+    Samples are added as they arrive and only these are processed: each
+    time a bin is complete its minimum and maximum are stored in a ring
+    buffer that holds as many bins as fit in the display window. Bins
+    are aligned to the first sample added, so they do not shift as the
+    window scrolls. Samples are identified by their number (an integer
+    index) rather than by their time.
+
+    window : :obj:`int`
+        Number of samples (per signal) in the display window.
+    width : :obj:`int`
+        Width of the plot in pixels.
+    nsignals : :obj:`int`
+        Number of signals.
+    dtype : :obj:`numpy.dtype`
+        Data type of the samples.
+    """
+
+    def __init__(self, window, width, nsignals, dtype='uint16'):
+        self.window = int(window)
+        self.width = max(int(width), 1)
+        # Samples per bin. With fewer than two samples per pixel column
+        # there is nothing to gain, so samples are kept as they are.
+        self.step = -(-self.window // self.width)
+        if self.step <= 2:
+            self.step = 1
+        nbins = -(-self.window // self.step)
+        npoints = nbins if self.step == 1 else 2 * nbins
+        self._index = RingBuffer(npoints, dtype='int64')
+        self._y = RingBuffer(npoints, nsignals, dtype=dtype)
+        # Samples of the last, incomplete bin, and number of the first
+        # of them.
+        self._partial = np.empty((self.step, nsignals), dtype=dtype)
+        self._npartial = 0
+        self._partial_index = 0
+
+    def clear(self):
+        self._index.clear()
+        self._y.clear()
+        self._npartial = 0
+
+    def _add_bins(self, index, y):
+        # Add the bins of *y*, whose first sample is number *index*.
+        if self.step == 1:
+            self._index.extend(np.arange(index, index + len(y)))
+            self._y.extend(y)
+            return
+        nbins = len(y) // self.step
+        indices = np.empty(2*nbins, dtype='int64')
+        indices[0::2] = np.arange(index, index + len(y), self.step)
+        indices[1::2] = indices[0::2] + (self.step - 1)
+        self._index.extend(indices)
+        self._y.extend(_minmax(y, self.step))
+
+    def extend(self, index, y):
+        '''
+        Add new samples *y* (samples x signals), the first of which is
+        sample number *index*.
+        '''
+        step = self.step
+        nsamples = len(y)
+        start = 0
+        # Complete the bin left incomplete last time.
+        if self._npartial:
+            start = min(step - self._npartial, nsamples)
+            end = self._npartial + start
+            self._partial[self._npartial:end] = y[:start]
+            self._npartial = end
+            if self._npartial < step:
+                return
+            self._add_bins(self._partial_index, self._partial)
+            self._npartial = 0
+        # Whole bins, all at once, and whatever is left over.
+        end = start + ((nsamples - start) // step) * step
+        if end > start:
+            self._add_bins(index + start, y[start:end])
+        self._npartial = nsamples - end
+        self._partial[:self._npartial] = y[end:]
+        self._partial_index = index + end
+
+    def get(self):
+        '''
+        Return the numbers of the decimated samples and the samples,
+        including those of the last, incomplete bin, as new arrays.
+        '''
+        partial_index = np.arange(self._partial_index,
+                                  self._partial_index + self._npartial)
+        return (np.concatenate(self._index.views() + (partial_index,)),
+                np.concatenate(self._y.views() +
+                               (self._partial[:self._npartial],)))
@@ -12,13 +12,17 @@ User settings
 
 The user must:
 
-(1) Define the correct BAUD rate to match that of the master. The
-    default 115200 baud rate is probably a good choice.
+(1) Define the correct BAUD rate to match that of the master (`baud`
+    in pydaq's configuration). The default 115200 baud rate is probably
+    a good choice. Pydaq only suggests rates up to `max_baud` (115200
+    by default); raise it if the firmware is built for a higher rate.
 (2) Set the right number of (analog) signals by (a) defining the
     required AnalogIn pins and their corresponding values, and (b)
     modifying the `read_adc` function so that those pins are read and
     their values are placed in the data buffer. Other data sources (e.g.
     SPI or 2-Wire) can be added in a similar way.
+(3) Set MAX_SAMPLING_FREQ to the highest sampling frequency at which
+    all the signals can be read (and sent at the BAUD rate).
 
 
 Summary
@@ -35,6 +39,39 @@ If the character 'R' is received from the master at any time during data
 acquisition the system will reset, thus freezing again the mbed again
 until a new configuration input is received from the master.
 
+Signals may be sampled at a lower rate than the sampling frequency. The
+master sets this, before the configuration string, with a 'D' followed
+by the divider of each signal (3 digits each) separated by commas and a
+new line, e.g. 'D001,002,010\n': the first signal is sampled on every
+tick of the sampling frequency, the second one every other tick, and the
+third one every tenth tick. By default (and after a reset) all dividers
+are 1.
+
+Configuration protocol version 2
+--------------------------------
+
+The configuration string above ('T' and 'F') limits the sampling
+frequency to 999 Hz. The master may instead send a self-describing
+message (see `protocol.py` in pydaq):
+
+    V002 <length> <payload>\n
+
+e.g. 'V002 0035 t=1494345706;f=2000;n=3;d=u16;p=400\n', where `length`
+is the number of characters of the payload (4 digits), and the payload
+is a list of key=value fields separated by semicolons: timestamp (t),
+sampling frequency (f), number of signals (n), sample encoding (d),
+ticks of the sampling frequency per data packet (p) and, optionally,
+sampling dividers (s, separated by commas). The mbed replies in the
+same format with the configuration it will use: the sampling frequency
+is limited to MAX_SAMPLING_FREQ, `n` is `number_of_signals`, `p` is
+reduced to fit the data buffer, and the reply adds the number of
+samples per data packet (b), BUFFER_SIZE (bmax), MAX_SAMPLING_FREQ
+(fmax) and the sample encodings supported (e).
+
+The sample encoding is either 'u16' (the default, see below) or 'p12',
+in which 12-bit samples are packed two in three bytes, saving a quarter
+of the serial bandwidth (see `pack_p12` in pydaq's `framing.py`).
+
 
 Data output
 -----------
@@ -63,23 +100,51 @@ bytes each upon sending, effectively sending twice as many bytes as
 there are samples, but the master should be aware of this and unpack the
 data accordingly.)
 
+With the 'p12' encoding, each pair of samples s0, s1 is sent as three
+bytes: s0 & 0xff, (s0 >> 8) | ((s1 & 0xf) << 4), and s1 >> 4. If there
+is an odd number of samples, the last one is paired with a 0. Samples
+keep their 12 least significant bits. Packed data may then look like a
+header (e.g. samples 0xfff); the master tells them apart by their
+position, as headers come every packet.
+
+If some signals are sampled at a lower rate, on each tick only the
+signals due are added, in order. E.g. with dividers 1, 2 and 4:
+
+    adc0_sample_0
+    adc1_sample_0
+    adc2_sample_0
+    adc0_sample_1
+    adc0_sample_2
+    adc1_sample_1
+    adc0_sample_3
+    adc0_sample_4
+    ...
+
+Each packet covers a whole number of cycles of the dividers (here, 4
+ticks), so that all packets have the same layout.
+
 Principles of operation
 -----------------------
 
 * A vector of fixed size (BUFFER_SIZE) is initialised to a large, fixed
  value, e.g. 1024.
 
-* Data are sent every 0.2 seconds. But to ensure that no samples are
-  lost, this is not done based on time but on the number of samples
+* Data are sent every 0.2 seconds (or every `p` ticks, with protocol
+  version 2). But to ensure that no samples are lost, this is not done based on time but on the number of samples
   acquired during that time. Fo example, if 3 signals are sampled at
   100 Hz, in 0.2 seconds there will be 20 samples per signal, or 60
   samples in total (0.2 * 100 * 3). In this case the data will be sent
   whenever the buffer completes the acquisition of 60 samples
   (`output_size`).
 
-* TODO if somehow output_size is larger than BUFFER_SIZE the system will
-  stop reading/sending data and instead a flashing led will be used to
-  signal the error.
+* If the samples taken in 0.2 seconds do not fit in BUFFER_SIZE, fewer
+  ticks are sent in each data packet, but never less than one cycle of
+  the dividers. A cycle must then fit in BUFFER_SIZE, and take at most
+  65535 ticks: the dividers 1, 2 and 4 above take 7 samples in 4
+  ticks, but e.g. 503 and 509 would take 1012 samples in 256027
+  ticks. Dividers that do not fit are rejected, and all signals are
+  sampled on every tick instead. (Pydaq refuses such signals before
+  configuring the mbed; see `protocol.BUFFER_SAMPLES`.)
 
 
 Caveats
@@ -108,6 +173,11 @@ User-defined variables
 // Acquisition definitions.
 #define BAUD 115200
 
+// Highest sampling frequency (Hz) that can be configured with protocol
+// version 2. This depends on the time taken by `read_adc` and on the
+// BAUD rate.
+#define MAX_SAMPLING_FREQ 20000
+
 // If defined, the ADC will not read data and instead timer values will
 // be packed and sent. Useful for testing that data packing, sending,
 // and unpacking work as expected.
@@ -148,6 +218,15 @@ volatile uint16_t buffer_index  = 0;
 volatile bool     buffer_select = 0;
 volatile bool     buffer_ready  = false;
 
+// Sampling dividers. Signal i is sampled every `divider[i]` ticks of
+// the sampler; `cycle` is the least common multiple of the dividers,
+// after which the sampling pattern repeats. `tick` counts the ticks
+// since the beginning of the current data packet.
+uint16_t divider[number_of_signals];
+uint16_t cycle = 1;
+volatile uint16_t tick = 0;
+char divider_buffer[4 * number_of_signals + 1];
+
 // Configuration variables.
 // `config_buffer` is a character array used for storing the
 // configuration string sent by the master. This string is expected to
@@ -161,6 +240,13 @@ float sampling_freq;
 char config_buffer[15];
 volatile uint32_t timestamp = 0;
 
+// Protocol version 2. `message_buffer` stores the message sent by the
+// master after the 'V', up to the new line.
+char message_buffer[256];
+uint32_t ticks_per_packet = 0;
+// Whether samples are sent packed ('p12' encoding), as 12 bits each.
+bool packed = false;
+
 // An LED to signal 'waiting for configuration'.
 DigitalOut led1(LED1);
 #ifdef CAMERA_PIN
@@ -170,7 +256,12 @@ DigitalOut picamera(CAMERA_PIN);
 // Function prototypes.
 void serial_rx_interrupt();
 void reset();
+void set_dividers();
 void configure();
+void configure_v2();
+uint16_t set_cycle();
+void set_packet_size();
+void start_sampling();
 void read_adc();
 void send_data();
 
@@ -213,14 +304,20 @@ void read_adc(){
     // but the result is the same if the value is simply right
     // shifted by 4.)
 #endif
-    // Move samples to data buffer.
-    data_buffer[buffer_select][buffer_index] = val_0; buffer_index++;
-    data_buffer[buffer_select][buffer_index] = val_1; buffer_index++;
-    data_buffer[buffer_select][buffer_index] = val_2; buffer_index++;
+    // Move the samples of the signals due on this tick to data buffer.
+    const uint16_t values[number_of_signals] = {val_0, val_1, val_2};
+    for (uint8_t i = 0; i < number_of_signals; i++){
+        if (tick % divider[i] == 0){
+            data_buffer[buffer_select][buffer_index] = values[i];
+            buffer_index++;
+        }
+    }
+    tick++;
 
     // Raise flag if the buffer is ready to be sent.
     if (buffer_index == output_size){
         buffer_index = 0;
+        tick = 0;
         buffer_ready = true;
         buffer_select = !buffer_select;
     }
@@ -238,6 +335,19 @@ void send_data(){
     // pc.putc((uint8_t)(timestamp >> 16));
     // pc.putc((uint8_t)(timestamp >> 24));
     // Data buffer.
+    if (packed){
+        for (uint16_t i = 0; i < output_size; i += 2){
+            uint16_t s0 = data_buffer[!buffer_select][i] & 0xfff;
+            uint16_t s1 = 0;
+            if (i + 1 < output_size){
+                s1 = data_buffer[!buffer_select][i + 1] & 0xfff;
+            }
+            pc.putc((uint8_t)(s0 & 0xff));
+            pc.putc((uint8_t)((s0 >> 8) | ((s1 & 0xf) << 4)));
+            pc.putc((uint8_t)(s1 >> 4));
+        }
+        return;
+    }
     for (uint16_t i = 0; i < output_size; i++){
         pc.putc((uint8_t)(data_buffer[!buffer_select][i] & 0xff));
         pc.putc((uint8_t)(data_buffer[!buffer_select][i] >> 8));
@@ -268,6 +378,34 @@ void serial_rx_interrupt(){
             // thread.
             queue.call(&configure);
         }
+        // 'D' signals the beginning of the sampling dividers, which
+        // end with a new line.
+        else if (input == 'D'){
+            uint8_t i = 0;
+            char c = pc.getc();
+            while (c != '\n'){
+                if (i < sizeof(divider_buffer) - 1){
+                    divider_buffer[i++] = c;
+                }
+                c = pc.getc();
+            }
+            divider_buffer[i] = '\0';
+            queue.call(&set_dividers);
+        }
+        // 'V' signals the beginning of a version 2 configuration
+        // message, which ends with a new line.
+        else if (input == 'V'){
+            uint16_t i = 0;
+            char c = pc.getc();
+            while (c != '\n'){
+                if (i < sizeof(message_buffer) - 1){
+                    message_buffer[i++] = c;
+                }
+                c = pc.getc();
+            }
+            message_buffer[i] = '\0';
+            queue.call(&configure_v2);
+        }
     }
 }
 
@@ -278,41 +416,204 @@ void reset(){
     buffer_index  = 0;
     buffer_select = 0;
     buffer_ready  = false;
+    tick = 0;
+    packed = false;
+    for (uint8_t i = 0; i < number_of_signals; i++){
+        divider[i] = 1;
+    }
     led1 = 1;
 #ifdef CAMERA_PIN
     picamera = 1;
 #endif
 }
 
+uint16_t gcd(uint16_t a, uint16_t b){
+    while (b != 0){
+        uint16_t t = b;
+        b = a % b;
+        a = t;
+    }
+    return a;
+}
+
+void set_dividers(){
+    // Parse the dividers, e.g. "001,002,010". They are only set if
+    // there is one (larger than 0) for each signal.
+    uint16_t values[number_of_signals];
+    char *position = divider_buffer;
+    char *end;
+    for (uint8_t i = 0; i < number_of_signals; i++){
+        long value = strtol(position, &end, 10);
+        if (end == position || value < 1){
+            return;
+        }
+        values[i] = (uint16_t)value;
+        position = (*end == ',') ? end + 1 : end;
+    }
+    for (uint8_t i = 0; i < number_of_signals; i++){
+        divider[i] = values[i];
+    }
+}
+
 void configure() {
     // Get configuration variables.
     sscanf(config_buffer, "%liF%f", &seconds, &sampling_freq);
+    // Version 1 only sends unpacked samples.
+    packed = false;
 
-    // Set-up time and timer.
-    set_time(seconds);
-    timer.start();
+    // Data packets cover 0.2 seconds. If the sampling frequency is too
+    // low this would be 0 ticks, e.g. if sampling_freq is 1 Hz,
+    // int(1 * 0.2) = 0; `set_packet_size` then sends one cycle per
+    // packet.
+    ticks_per_packet = (uint32_t)(sampling_freq * 0.2);
+    set_packet_size();
+
+    // Send back the received values to the master for confirmation.
+    pc.printf("%i %3.0f %u\n", seconds, sampling_freq, output_size);
+    start_sampling();
+}
+
+void configure_v2() {
+    // Parse a version 2 message, e.g.
+    // "002 0035 t=1494345706;f=2000;n=3;d=u16;p=400". Messages of
+    // other versions, or truncated, are ignored.
+    unsigned int version, length;
+    int start = 0;
+    if (sscanf(message_buffer, "%u %u %n", &version, &length,
+               &start) < 2 || version != 2 ||
+            strlen(message_buffer + start) != length){
+        return;
+    }
+    bool dividers_given = false;
+    ticks_per_packet = 0;
+    packed = false;
+    char *item = strtok(message_buffer + start, ";");
+    while (item != NULL){
+        char *value = strchr(item, '=');
+        if (value != NULL){
+            *value++ = '\0';
+            if (strcmp(item, "t") == 0){
+                seconds = strtol(value, NULL, 10);
+            }
+            else if (strcmp(item, "f") == 0){
+                sampling_freq = strtol(value, NULL, 10);
+            }
+            else if (strcmp(item, "p") == 0){
+                ticks_per_packet = strtoul(value, NULL, 10);
+            }
+            else if (strcmp(item, "d") == 0){
+                // Unknown encodings are replaced by 'u16'.
+                packed = (strcmp(value, "p12") == 0);
+            }
+            else if (strcmp(item, "s") == 0){
+                strncpy(divider_buffer, value, sizeof(divider_buffer) - 1);
+                divider_buffer[sizeof(divider_buffer) - 1] = '\0';
+                dividers_given = true;
+            }
+            // The number of signals (n) is that of this firmware, as
+            // the reply tells the master.
+        }
+        item = strtok(NULL, ";");
+    }
 
+    // Settings that cannot be met are replaced by those that can.
+    if (sampling_freq > MAX_SAMPLING_FREQ){
+        sampling_freq = MAX_SAMPLING_FREQ;
+    }
+    if (sampling_freq < 1){
+        sampling_freq = 1;
+    }
+    for (uint8_t i = 0; i < number_of_signals; i++){
+        divider[i] = 1;
+    }
+    if (dividers_given){
+        set_dividers();
+    }
+    if (ticks_per_packet == 0){
+        ticks_per_packet = (uint32_t)(sampling_freq * 0.2);
+    }
+    set_packet_size();
+
+    // Reply with the configuration used.
+    char reply[192];
+    int n = snprintf(reply, sizeof(reply), "t=%li;f=%u;n=%u;d=%s;p=%u;s=",
+                     (long)seconds, (unsigned int)sampling_freq,
+                     number_of_signals, packed ? "p12" : "u16",
+                     ticks_per_packet);
+    for (uint8_t i = 0; i < number_of_signals; i++){
+        n += snprintf(reply + n, sizeof(reply) - n, i ? ",%u" : "%u",
+                      divider[i]);
+    }
+    n += snprintf(reply + n, sizeof(reply) - n,
+                  ";b=%u;bmax=%u;fmax=%u;e=u16,p12", output_size,
+                  BUFFER_SIZE, MAX_SAMPLING_FREQ);
+    pc.printf("V002 %04u %s\n", n, reply);
+    start_sampling();
+}
+
+uint16_t set_cycle(){
+    // Set `cycle` to the least common multiple of the dividers, and
+    // return the number of samples taken in a cycle, or 0 if these do
+    // not fit in the data buffer.
+    uint32_t ticks = 1;
+    uint32_t samples = 0;
+    for (uint8_t i = 0; i < number_of_signals; i++){
+        ticks = ticks / gcd(ticks, divider[i]) * divider[i];
+        if (ticks > 0xffff){
+            return 0;
+        }
+    }
+    for (uint8_t i = 0; i < number_of_signals; i++){
+        samples += ticks / divider[i];
+    }
+    if (samples > BUFFER_SIZE){
+        return 0;
+    }
+    cycle = ticks;
+    return samples;
+}
+
+void set_packet_size() {
     // `output_size` is the number of sample size in each data packet
-    // sent to the master. It is calculated so any samples acquired
-    // every 0.2 seconds are sent, based on the sampling frequency.
-    // To avoid missing samples it is critical that this value is a
-    // multiple of the number of signals.
+    // sent to the master: the samples acquired in `ticks_per_packet`
+    // ticks of the sampling frequency. To avoid missing samples it is
+    // critical that this value is a multiple of the number of signals.
     //
-    // What to do if (freq * saving_period * nsignals) is not an
-    // integer, e.g. as in sampling_freq = 118, (118 * 0.2 * 3 = 70.8)?
-    // The  solution is to cast to integer before multiplying by
-    // number_of_signals; that way the result will always be an integer
-    // exact multiple of number_of_signals.
-    output_size = (uint16_t)(sampling_freq * 0.2) * number_of_signals;
-    // If the sampling frequency is too low the operation above will
-    // result in 0; for example, if sampling_freq is 1 Hz,
-    // int(1 * 0.2) = 0. These lines avoid that situation.
-    if (output_size == 0){
-        output_size = number_of_signals;
+    // If signals are sampled at different rates, the packet must also
+    // cover a whole number of cycles of the dividers, so that all
+    // packets have the same layout. The number of ticks is rounded
+    // down to a multiple of the cycle, and `output_size` is the number
+    // of samples taken in those ticks. The packet must also fit in the
+    // data buffer. `ticks_per_packet` is updated to the ticks actually
+    // sent.
+    //
+    // If a cycle does not fit in the data buffer (or in `cycle`), the
+    // dividers are rejected and all signals are sampled on every tick
+    // instead. The reply to protocol version 2 tells the master, which
+    // finds the dividers changed.
+    uint16_t per_cycle = set_cycle();
+    if (per_cycle == 0){
+        for (uint8_t i = 0; i < number_of_signals; i++){
+            divider[i] = 1;
+        }
+        per_cycle = set_cycle();
     }
+    uint32_t ncycles = ticks_per_packet / cycle;
+    if (ncycles > BUFFER_SIZE / per_cycle){
+        ncycles = BUFFER_SIZE / per_cycle;
+    }
+    if (ncycles == 0){
+        ncycles = 1;
+    }
+    ticks_per_packet = ncycles * cycle;
+    output_size = ncycles * per_cycle;
+    tick = 0;
+}
 
-    // Send back the received values to the master for confirmation.
-    pc.printf("%i %3.0f %u\n", seconds, sampling_freq, output_size);
+void start_sampling() {
+    // Set-up time and timer.
+    set_time(seconds);
+    timer.start();
 
     // Start ticker. 'Ticker.attach' takes the interval value in seconds
     // (float), thus the inverse of the sampling frequency.
@@ -328,6 +629,10 @@ void configure() {
 
 int main(){
     pc.baud(BAUD);
+    // Sample all signals on every tick until told otherwise.
+    for (uint8_t i = 0; i < number_of_signals; i++){
+        divider[i] = 1;
+    }
     // Switch on 'waiting for configuration' led.
     led1 = 1;
 #ifdef CAMERA_PIN
@@ -0,0 +1,474 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+import math
+
+import numpy as np
+
+
+class PacketFramer(object):
+    """
+    Split a stream of serial data into data packets.
+
+    The microcontroller sends packets made of a header (by default four
+    0xff bytes) followed by `nsamples` samples of type `dtype`. Bytes
+    read from the serial port are added to the framer with `feed` and
+    all the complete packets are then extracted at once with `frame`.
+    Alternatively, data can be read straight into the framer's buffer
+    with `reserve` and `commit`, e.g.::
+
+        nbytes = serial_port.readinto(framer.reserve(1024))
+        framer.commit(nbytes)
+
+    A packet is complete only when it is followed by the header of the
+    next packet; if that header is not where expected the packet is
+    corrupt and it is discarded, and the framer searches the data for
+    the next header (resynchronisation), preferably one in step with
+    the packets before. Thus corrupted or missing bytes cost only the
+    packet(s) they affect.
+
+    nsamples : :obj:`int`
+        Number of samples in each packet (all signals).
+    nsignals : :obj:`int`
+        Number of signals. `nsamples` must be a multiple of this. The
+        samples are returned in rows of this size; with `nsamples`,
+        one row per packet.
+    dtype : :obj:`numpy.dtype`
+        Type of the samples. Defaults to little-endian uint16.
+    header : :obj:`bytes`
+        Start sequence of each packet.
+    capacity : :obj:`int`
+        Size of the internal buffer, in packets.
+    packed : :obj:`bool`
+        Whether the samples are 12-bit values packed two in three bytes
+        (see `pack_p12`). They are returned as uint16.
+    """
+
+    def __init__(self, nsamples, nsignals, dtype='<u2',
+                 header=b'\xff\xff\xff\xff', capacity=64, packed=False):
+        if nsamples % nsignals:
+            raise ValueError('Number of samples per packet ({}) must be '
+                             'a multiple of the number of signals '
+                             '({})'.format(nsamples, nsignals))
+        self.nsamples = nsamples
+        self.nsignals = nsignals
+        self.packed = packed
+        self.header = np.frombuffer(header, dtype='uint8')
+        self.header_size = len(header)
+        if packed:
+            self.dtype = np.dtype('uint16')
+            self.payload_size = 3 * ((nsamples + 1) // 2)
+        else:
+            self.dtype = np.dtype(dtype)
+            self.payload_size = nsamples * self.dtype.itemsize
+        self.packet_size = self.header_size + self.payload_size
+
+        # Reusable buffers: raw bytes, header mask and output samples.
+        size = capacity * self.packet_size
+        self._buffer = bytearray(size)
+        self._bytes = np.frombuffer(self._buffer, dtype='uint8')
+        self._view = memoryview(self._buffer)
+        self._size = 0
+        self._is_header = np.zeros(size, dtype=bool)
+        self._mask = np.zeros(size, dtype=bool)
+        self._samples = np.zeros(
+                (capacity * nsamples // nsignals, nsignals),
+                dtype=self.dtype)
+
+        # Counters.
+        self.packets = 0
+        self.resyncs = 0
+        self.dropped_bytes = 0
+        self.synchronised = False
+        # Packed data only: headers found in a longer run of header
+        # bytes (see `_count_ambiguous`).
+        self.ambiguous_headers = 0
+        # Packed data only: whether the first byte in the buffer is a
+        # header in step with the packets before, and the number of
+        # header bytes that came just before the last such header (the
+        # end of the previous packet; see `_pick_header`).
+        self._in_step = False
+        self._run_offset = 0
+
+    @property
+    def space(self):
+        '''
+        Number of bytes that can be added to the internal buffer.
+        '''
+        return len(self._buffer) - self._size
+
+    def feed(self, data):
+        '''
+        Add *data* (bytes) to the internal buffer.
+        '''
+        n = len(data)
+        if n > self.space:
+            raise ValueError('Not enough space in framing buffer')
+        self._buffer[self._size:self._size+n] = data
+        self._size += n
+
+    def reserve(self, nbytes):
+        '''
+        Return a writable view of (up to) the next *nbytes* of free
+        space in the internal buffer. Once data have been written into
+        this view, call `commit` with the number of bytes written.
+        '''
+        return self._view[self._size:self._size+nbytes]
+
+    def commit(self, nbytes):
+        '''
+        Add to the buffer *nbytes* that were written into the view
+        returned by `reserve`.
+        '''
+        if nbytes > self.space:
+            raise ValueError('Not enough space in framing buffer')
+        self._size += nbytes
+
+    def _find_headers(self, n):
+        # Mark every position in the first `n` bytes at which a header
+        # starts. This is done for all positions at once by comparing
+        # shifted copies of the data with each header byte.
+        is_header = self._is_header[:n]
+        mask = self._mask[:n]
+        np.equal(self._bytes[:n], self.header[0], out=is_header)
+        for (i, byte) in enumerate(self.header[1:], 1):
+            np.equal(self._bytes[i:i+n], byte, out=mask)
+            is_header &= mask
+        if self.packed:
+            # Packed samples may hold any bytes, including runs of
+            # header bytes before, after or instead of a header. All the
+            # positions are kept, and `frame` picks the one that is in
+            # step with the packets around it.
+            return is_header
+        # The first sample after a header may start with a header byte
+        # (e.g. 0x0fff is sent as b'\xff\x0f'), which would match the
+        # header one byte too late. Only the first position of each run
+        # is a header. The last byte of a valid packet is never a header
+        # byte (samples are 15 bits or less).
+        np.not_equal(self._bytes[:n-1], self.header[-1], out=mask[1:])
+        mask[0] = True
+        is_header &= mask
+        return is_header
+
+    def frame(self):
+        '''
+        Extract all complete packets in the internal buffer.
+
+        Returns a 2-D array of samples x signals. The array is a view of
+        an internal buffer and it is only valid until the next call.
+        '''
+        size = self.packet_size
+        # Positions where a header may start (the last few bytes cannot
+        # hold a whole header yet).
+        n = self._size - self.header_size + 1
+        if n < 1:
+            return self._samples[:0]
+        is_header = self._find_headers(n)
+
+        position = 0
+        nrows = 0
+        in_step = self._in_step
+        while position < n:
+            if not is_header[position]:
+                # Skip to the next header, or discard all data if there
+                # is none.
+                following = int(np.argmax(is_header[position:n]))
+                if not is_header[position + following]:
+                    following = n - position
+                self.dropped_bytes += following
+                position += following
+                in_step = False
+                continue
+            if self.packed and not in_step:
+                chosen = self._pick_header(is_header, position, n)
+                self.dropped_bytes += chosen - position
+                position = chosen
+
+            # Check the position of all the headers that would follow if
+            # the data were not corrupted: packet k is valid if there is
+            # a header at its start and another one at its end.
+            ends = is_header[position+size:n:size]
+            npackets = len(ends)
+            if npackets and not ends.all():
+                npackets = int(np.argmin(ends))
+            if npackets:
+                if self.packed:
+                    self._count_ambiguous(is_header, position, npackets,
+                                          in_step, n)
+                nrows += self._copy_packets(position, npackets, nrows)
+                position += npackets * size
+                self.synchronised = True
+                in_step = True
+                if self.packed:
+                    self._run_offset = self._offset_in_run(is_header,
+                                                           position)
+
+            if position + size < n:
+                # There is a header at `position` but not where the next
+                # one should be: the packet is corrupt. Discard it and
+                # resynchronise, if possible on a header in step with
+                # this packet (i.e. the packet was damaged but not
+                # shortened) and confirmed by the header after it.
+                # Otherwise, on the next header found.
+                self.resyncs += 1
+                stride = is_header[position+size:n:size]
+                confirmed = stride[:-1] & stride[1:]
+                if confirmed.any():
+                    skip = (int(np.argmax(confirmed)) + 1) * size
+                else:
+                    skip = 1
+                    in_step = False
+                self.dropped_bytes += skip
+                position += skip
+            else:
+                # The packet is not complete yet.
+                break
+        self._in_step = in_step and position < n
+
+        # Move any leftover bytes to the start of the buffer.
+        remainder = self._size - position
+        self._bytes[:remainder] = self._bytes[position:self._size]
+        self._size = remainder
+        return self._samples[:nrows]
+
+    @staticmethod
+    def _offset_in_run(is_header, position):
+        # Number of header positions just before `position`, i.e. its
+        # offset in a run of header bytes.
+        offset = 0
+        while offset < position and is_header[position-offset-1]:
+            offset += 1
+        return offset
+
+    def _pick_header(self, is_header, position, n):
+        # Packed samples may be made of header bytes, so that a run of
+        # them holds several positions that look like a header, e.g.
+        # b'\xff' * 5 if the last byte of a packet or the first byte of
+        # the next one is 0xff. When resynchronising, the header is the
+        # position in the run (from `position` on, and within one
+        # packet) followed by the most packets with a header at both
+        # ends. If several are equally good, e.g. if a signal is
+        # saturated, prefer the one with about as many header bytes
+        # before it as the last header in step with its packets.
+        size = self.packet_size
+        run = int(np.argmin(is_header[position:n]))
+        if not is_header[position+run]:
+            run = min(run, size)
+        else:
+            run = min(n - position, size)
+        if run < 2:
+            return position
+        start = position - self._offset_in_run(is_header, position)
+        last = position + run - 1
+        horizon = len(is_header[last+size:n:size])
+        best = None
+        for candidate in range(position, last + 1):
+            ends = is_header[candidate+size:n:size][:horizon]
+            count = len(ends) if ends.all() else int(np.argmin(ends))
+            score = (count, -abs(candidate - start - self._run_offset))
+            if best is None or score > best[0]:
+                best = (score, candidate)
+        return best[1]
+
+    def _count_ambiguous(self, is_header, start, npackets, in_step, n):
+        # A header next to a saturated sample is part of a longer run of
+        # header bytes, in which it is found at more than one position.
+        # If a byte is lost while this is so, the packets are shifted by
+        # one byte and yet the headers are still where expected, so that
+        # the loss goes unnoticed. Count the headers at both ends of
+        # `npackets` packets from `start` that are in such a run, so
+        # that users can tell when packed data may be misaligned. The
+        # first header is not counted if in step, as it was counted as
+        # the end of the packet before; a run after the last one is
+        # missed if its next byte has not arrived yet.
+        size = self.packet_size
+        first = start + size if in_step else start
+        positions = np.arange(first, start + npackets * size + 1, size)
+        before = is_header[np.maximum(positions - 1, 0)] & (positions > 0)
+        after = is_header[np.minimum(positions + 1, n - 1)] & (
+                positions + 1 < n)
+        self.ambiguous_headers += int(np.count_nonzero(before | after))
+
+    def _copy_packets(self, start, npackets, nrows):
+        # Copy the samples of `npackets` consecutive packets, skipping
+        # their headers, into the output buffer. Returns the number of
+        # rows added.
+        packets = self._bytes[start:start+npackets*self.packet_size]
+        packets = packets.reshape(npackets, self.packet_size)
+        rows = npackets * self.nsamples // self.nsignals
+        output = self._samples[nrows:nrows+rows]
+        if self.packed:
+            unpack_p12(packets[:, self.header_size:], self.nsamples,
+                       out=output.reshape(npackets, self.nsamples))
+        else:
+            payload = packets[:, self.header_size:].view(self.dtype)
+            output.reshape(npackets, self.nsamples)[...] = payload
+        self.packets += npackets
+        return rows
+
+
+def pack_p12(samples):
+    '''
+    Pack 12-bit *samples* two in three bytes and return the bytes.
+
+    Samples s0 and s1 are packed as:
+
+        byte 0: bits 0-7 of s0
+        byte 1: bits 8-11 of s0 (low nibble), bits 0-3 of s1 (high)
+        byte 2: bits 4-11 of s1
+
+    Only the 12 least significant bits of each sample are kept. An odd
+    number of samples is padded with a 0. Packed data may look like a
+    packet header (e.g. samples 0xfff), which `PacketFramer` tells
+    apart by its position.
+    '''
+    samples = np.asarray(samples).ravel().astype('uint16') & 0xfff
+    if len(samples) % 2:
+        samples = np.append(samples, np.uint16(0))
+    (even, odd) = (samples[0::2], samples[1::2])
+    packed = np.empty((len(even), 3), dtype='uint8')
+    packed[:, 0] = even & 0xff
+    packed[:, 1] = (even >> 8) | ((odd & 0x0f) << 4)
+    packed[:, 2] = odd >> 4
+    return packed.tobytes()
+
+
+def unpack_p12(payload, nsamples, out=None):
+    '''
+    Unpack samples packed by `pack_p12`. *payload* is an array of bytes
+    (uint8) whose last axis holds the packed samples, e.g. one packet
+    per row. Returns an array (uint16) with *nsamples* samples in the
+    last axis, or fills in *out*.
+    '''
+    payload = np.asarray(payload, dtype='uint8')
+    shape = payload.shape[:-1]
+    triplets = payload.reshape(shape + (-1, 3))
+    if out is None:
+        out = np.empty(shape + (nsamples,), dtype='uint16')
+    # Even samples (s0) take all the triplets; odd ones (s1) do not
+    # take the padding, if any.
+    even = out[..., 0::2]
+    odd = out[..., 1::2]
+    nodd = nsamples // 2
+    np.bitwise_and(triplets[..., 1], 0x0f, out=even)
+    even <<= 8
+    even |= triplets[..., 0]
+    odd[...] = triplets[..., :nodd, 2]
+    odd <<= 4
+    odd |= triplets[..., :nodd, 1] >> 4
+    return out
+
+
+def sampling_dividers(base_freq, freqs):
+    '''
+    Return the divider of each of the sampling frequencies *freqs*,
+    i.e. how many ticks of the base sampling frequency *base_freq* go
+    by between two samples. Raises ValueError if a frequency is not an
+    exact divisor of the base frequency.
+    '''
+    dividers = []
+    for freq in freqs:
+        if freq <= 0 or base_freq % freq:
+            raise ValueError(
+                    'Sampling frequency {} Hz is not a divisor of the '
+                    'base sampling frequency ({} Hz)'.format(
+                            freq, base_freq))
+        dividers.append(int(base_freq // freq))
+    return dividers
+
+
+class Demultiplexer(object):
+    """
+    Split data packets of signals sampled at different rates.
+
+    The microcontroller samples at a base frequency (a tick) and each
+    signal every `divider` ticks. On each tick the samples of the
+    signals due are added to the packet in signal order, so a packet
+    looks like e.g.::
+
+        s0 s1 s2 | s0 | s0 s1 | s0 | s0 s1 s2 | ...
+
+        (dividers 1, 2 and 4: signal 0 every tick, 1 every other tick,
+        2 every fourth tick)
+
+    Every packet spans a whole number of cycles of the dividers, so all
+    packets have the same layout. The positions of the samples of each
+    signal within a packet are worked out once, and then whole batches
+    of packets are split with a single indexing operation.
+
+    dividers : :obj:`list` of :obj:`int`
+        Divider of each signal (see `sampling_dividers`).
+    nsamples : :obj:`int`
+        Number of samples in each packet (all signals), as reported by
+        the microcontroller. It must hold a whole number of cycles.
+    """
+
+    def __init__(self, dividers, nsamples):
+        self.dividers = [int(divider) for divider in dividers]
+        self.nsignals = len(self.dividers)
+        # Ticks in a cycle, after which the pattern repeats, and samples
+        # in a cycle.
+        cycle = 1
+        for divider in self.dividers:
+            cycle = cycle * divider // math.gcd(cycle, divider)
+        per_cycle = sum(cycle // divider for divider in self.dividers)
+        if nsamples % per_cycle:
+            raise ValueError('Number of samples per packet ({}) does not '
+                             'match the sampling dividers {}'.format(
+                                     nsamples, self.dividers))
+        self.nsamples = nsamples
+        self.ticks = nsamples // per_cycle * cycle
+
+        # The signal of every sample in a packet, in the order sent;
+        # and the samples of each signal, in time order.
+        ticks = np.arange(self.ticks)[:, np.newaxis]
+        due = ticks % self.dividers == 0
+        signal_of = np.nonzero(due)[1]
+        self._order = np.argsort(signal_of, kind='stable')
+        self.counts = [self.ticks // divider for divider in self.dividers]
+        self._offsets = np.concatenate(([0], np.cumsum(self.counts)))
+
+        # For display: the position of the last sample of each signal
+        # taken at or before each tick (sample and hold).
+        position = np.full(due.shape, -1)
+        position[due] = np.arange(nsamples)
+        last = ticks - ticks % self.dividers
+        self._hold = position[last, np.arange(self.nsignals)]
+
+    def split(self, packets):
+        '''
+        Split *packets* (packets x samples) into the samples of each
+        signal. Returns a list of 1-D arrays, one per signal, in time
+        order.
+        '''
+        npackets = len(packets)
+        ordered = packets[:, self._order]
+        return [ordered[:, start:end].reshape(npackets * (end - start))
+                for (start, end) in zip(self._offsets[:-1],
+                                        self._offsets[1:])]
+
+    def expand(self, packets):
+        '''
+        Return the samples in *packets* (packets x samples) at the base
+        frequency (ticks x signals), repeating the last sample of
+        signals sampled less often.
+        '''
+        return packets[:, self._hold].reshape(
+                len(packets) * self.ticks, self.nsignals)
@@ -23,12 +23,13 @@ import datetime as dt
 import time
 from PyQt5 import (QtCore, QtGui, QtWidgets)
 import pyqtgraph as pg
-import numpy as np
 from serial import (SerialException)
 
 from ui.ui_main import Ui_MainWindow
 from acquisition import DataAcquisition
+from recording import dropped_warning
 from dialogs import ConfigurationDialog
+from display import MinMaxDecimator
 
 
 class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
@@ -37,6 +38,9 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     '''
     # GUI refresh rate in milliseconds.
     GUI_REFRESH_RATE = 100
+    # How often (seconds) to check for data records dropped while
+    # recording.
+    RECORDING_CHECK_PERIOD = 1
 
     def __init__(self, parent=None):
         QtWidgets.QWidget.__init__(self, parent)
@@ -47,6 +51,8 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.markersGroupBox.setDisabled(True)
 
         self.daq = DataAcquisition()
+        self._dropped_records = 0
+        self._next_recording_check = 0
 
     def on_quitButton_clicked(self, checked=None):
         if checked is None:
@@ -71,12 +77,6 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         dialog = ConfigurationDialog(self.daq.config, parent=self)
         ok_clicked = dialog.exec_()
         if ok_clicked:
-            # TODO EDF allows to acquire each signal at different sample
-            # rates, but for the time being this software aquires all
-            # signals at the same rate. These lines are to ensure that
-            # the signals' sampling frequency match.
-            for signal in self.daq.config.signals:
-                signal.sampling_freq = self.daq.config.sampling_freq
             # At low sampling frequencies the GUI refresh rate must
             # be slowed down to avoid errors. GUI refresh rate is in
             # milliseconds.
@@ -96,7 +96,13 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                 caption='Select configuration file')
         config_f = config_f[0]
         if config_f:
-            self.daq.config.load(config_f)
+            try:
+                self.daq.config.load(config_f)
+            except ValueError as error:
+                # Loaded anyway, to be corrected in the configuration
+                # dialog.
+                QtWidgets.QMessageBox.warning(self, 'Configuration error',
+                                              error.args[0])
 
     def on_saveConfigButton_clicked(self, checked=None):
         if checked is None:
@@ -123,6 +129,12 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self.statusbar.showMessage(msg)
             QtWidgets.QMessageBox.critical(self, msg, error.args[0])
             return False
+        except ValueError as error:
+            # E.g. the sampling frequencies of the signals do not match.
+            msg = 'Configuration error'
+            self.statusbar.showMessage(msg)
+            QtWidgets.QMessageBox.critical(self, msg, error.args[0])
+            return False
         else:
             # Display data
             self.setup_plot()
@@ -139,7 +151,6 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self.playButton.setDisabled(True)
             self.stopButton.setEnabled(True)
             self.configurationGroupBox.setDisabled(True)
-            self.captureGroupBox.setDisabled(True)
             self.display_status('running')
 
     def on_stopButton_clicked(self, checked=None):
@@ -168,7 +179,11 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def on_recordButton_clicked(self, checked=None):
         if checked is None:
             return
-        self.statusbar.showMessage('Connecting to µC...')
+        # If data are already being displayed recording starts straight
+        # away, without reconnecting to the microcontroller.
+        running = self.daq.running
+        if not running:
+            self.statusbar.showMessage('Connecting to µC...')
         try:
             self.daq.start_recording()
         except SerialException as error:
@@ -176,9 +191,16 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self.statusbar.showMessage(msg)
             QtWidgets.QMessageBox.critical(self, msg, error.args[0])
             return False
+        except ValueError as error:
+            # E.g. the sampling frequencies of the signals do not match.
+            msg = 'Configuration error'
+            self.statusbar.showMessage(msg)
+            QtWidgets.QMessageBox.critical(self, msg, error.args[0])
+            return False
         else:
             # Display data
-            self.setup_plot()
+            if not running:
+                self.setup_plot()
             # Disaplay information on statusbar
             self.statusbar.clearMessage()
             start = dt.datetime.fromtimestamp(self.daq.mcu.timestamp)
@@ -188,6 +210,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                     'Sampling frequency: {:.2f} Hz | '.format(
                             self.daq.config.sampling_freq) +
                     'Start: {}'.format(start))
+            self._dropped_records = 0
             # Reset buttons
             self.recordButton.setDisabled(True)
             self.stopRecordButton.setEnabled(True)
@@ -199,15 +222,15 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def on_stopRecordButton_clicked(self, checked=None):
         if checked is None:
             return
-        if hasattr(self, 'timer'):
-            self.timer.stop()
+        # Data acquisition and display continue after recording stops.
         self.daq.stop_recording()
         self.recordButton.setEnabled(True)
         self.stopRecordButton.setDisabled(True)
         self.displayGroupBox.setEnabled(True)
-        self.configurationGroupBox.setEnabled(True)
+        self.playButton.setDisabled(True)
+        self.stopButton.setEnabled(True)
         self.videoCheckBox.setEnabled(True)
-        self.display_status('stop')
+        self.display_status('running')
 
     def on_videoCheckBox_toggled(self):
         pass
@@ -235,13 +258,61 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     # Plotting functions ----------------------------------------------
 
     def update_plot(self):
-        with self.daq.lock:
-            x = np.array(self.daq.x)
-            y = np.array(self.daq.y).T
-            for (index, curve, samples) in zip(count(), self.curves, y):
-                if self.physUnitsCheckBox.isChecked():
-                    samples = self.daq.config.signals[index].dig_to_phys(samples)
-                curve.setData(x, samples)
+        # The display buffer is read without locking it (see
+        # `DataAcquisition.start`), so the reader thread is never held
+        # up. `nsamples` is the number of samples received so far. If
+        # no new samples have arrived since the last refresh there is
+        # nothing to do.
+        if time.monotonic() >= self._next_recording_check:
+            self._next_recording_check = (time.monotonic() +
+                                          self.RECORDING_CHECK_PERIOD)
+            self.check_recording()
+        y_buffer = self.daq.y
+        nsamples = y_buffer.count
+        if nsamples == self._plotted:
+            return
+        # Only the minimum and maximum values in each pixel column of
+        # the plots are drawn (see `display.MinMaxDecimator`), so that
+        # the number of points drawn is the same whatever the sampling
+        # rate. Only the samples received since the last refresh are
+        # decimated, unless the plots have been resized or samples have
+        # been missed, in which case the whole display window is.
+        width = self.graphicsView.width()
+        if (self._decimator is None or
+                self._decimator.width != width or
+                not 0 < nsamples - self._plotted <= y_buffer.capacity):
+            self._decimator = MinMaxDecimator(
+                    y_buffer.capacity, width, self.daq.config.nsignals,
+                    dtype=y_buffer.dtype)
+            self._plotted = 0
+        start = max(self._plotted, nsamples - y_buffer.capacity)
+        index = start
+        for y in y_buffer.tail(start, nsamples):
+            self._decimator.extend(index, y)
+            index += len(y)
+        if not y_buffer.intact(start):
+            # The samples were overwritten while being read. Start over
+            # with the latest samples in the next refresh.
+            self._decimator = None
+            return
+        self._plotted = nsamples
+        index, y = self._decimator.get()
+        x = self.daq.sample_time(index)
+        if self.physUnitsCheckBox.isChecked():
+            y = self.daq.config.dig_to_phys(y)
+        for (index, curve) in zip(count(), self.curves):
+            curve.setData(x, y[:, index])
+
+    def check_recording(self):
+        # Warn on the status bar if data records have been dropped since
+        # the last check.
+        if not self.daq.recording:
+            return
+        stats = self.daq.stats()
+        recorder = stats['recorder'] if stats else None
+        if recorder and recorder['dropped_records'] > self._dropped_records:
+            self._dropped_records = recorder['dropped_records']
+            self.statusbar.showMessage(dropped_warning(recorder))
 
     def setup_plot(self):
 
@@ -268,6 +339,8 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.graphicsView.setCentralItem(self.layout)
         self.plots = []
         self.curves = []
+        self._decimator = None
+        self._plotted = 0
 
         # Create a plot for each signal and initialise a curve for
         # each plot. These curves are the ones that will be updated
@@ -0,0 +1,355 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Data acquisition in a separate process.
+
+`DataAcquisition` reads the serial port in a thread, which shares the
+interpreter (and its global lock) with the graphical interface. If the
+interface is busy for long enough, the serial input buffer overflows
+and samples are lost. `ProcessAcquisition` runs `DataAcquisition`,
+including recording, in a child process instead. The samples to be
+displayed are published in ring buffers in shared memory, which the
+interface reads as it would those of `DataAcquisition`.
+
+Requires Python 3.8 or later (`multiprocessing.shared_memory`).
+'''
+
+import types
+import signal
+import multiprocessing
+
+import numpy as np
+from serial import SerialException
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8.
+    shared_memory = None
+
+from buffers import RingBuffer
+from configuration import Configuration
+from acquisition import DataAcquisition
+
+
+def _attach(name):
+    # Attach to an existing block of shared memory. Its owner (the
+    # process that created it) is responsible for destroying it.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no `track` argument, and always registers
+        # the memory with the resource tracker. This is the same tracker
+        # as that of the parent process, which already knows about it.
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedRingBuffer(RingBuffer):
+    """
+    A `buffers.RingBuffer` in shared memory, so that one process can
+    add rows while others read them.
+
+    The row counters (`count` and that of the rows being written) are
+    kept at the start of the shared memory as 64-bit integers, followed
+    by the rows. Creating or attaching to the buffer resets them.
+
+    capacity, shape, dtype, slack :
+        As in `buffers.RingBuffer`.
+    name : :obj:`str`
+        Name of the shared memory of an existing buffer, to attach to
+        it. If None, new shared memory is created.
+    """
+
+    _header_size = 16
+
+    def __init__(self, capacity, shape=(), dtype='uint16', slack=0,
+                 name=None):
+        if isinstance(shape, int):
+            shape = (shape,)
+        nbytes = ((int(capacity) + int(slack)) *
+                  int(np.prod(shape, dtype=int)) * np.dtype(dtype).itemsize)
+        if name is None:
+            self._memory = shared_memory.SharedMemory(
+                    create=True, size=self._header_size + nbytes)
+        else:
+            self._memory = _attach(name)
+        self.name = self._memory.name
+        self._counters = np.ndarray(2, dtype='int64',
+                                    buffer=self._memory.buf)
+        super().__init__(capacity, shape, dtype, slack,
+                         buffer=self._memory.buf[self._header_size:])
+
+    @property
+    def count(self):
+        return int(self._counters[0])
+
+    @count.setter
+    def count(self, value):
+        self._counters[0] = value
+
+    @property
+    def _writing(self):
+        return int(self._counters[1])
+
+    @_writing.setter
+    def _writing(self, value):
+        self._counters[1] = value
+
+    def close(self):
+        '''
+        Unmap the shared memory. The buffer cannot be used afterwards.
+        '''
+        self._data = None
+        self._counters = None
+        self._memory.close()
+
+    def unlink(self):
+        '''
+        Destroy the shared memory once all processes have closed it.
+        '''
+        self._memory.unlink()
+
+
+class _ChildAcquisition(DataAcquisition):
+    # Data acquisition that displays data in the shared ring buffer
+    # created by the parent process.
+
+    def __init__(self, buffer_name, **kwargs):
+        super().__init__(**kwargs)
+        self._buffer_name = buffer_name
+
+    def _display_buffer(self, maxlen, slack):
+        return SharedRingBuffer(maxlen, self.config.nsignals,
+                                dtype='uint16', slack=slack,
+                                name=self._buffer_name)
+
+
+def _run(conn, config, microcontroller, read_mode, port, seconds,
+         buffer_name):
+    # Main function of the child process. Start the acquisition and then
+    # carry out the commands received from the parent through *conn*,
+    # replying ('ok', result) or ('error', exception) to each.
+    # Interrupting (Ctrl-C) is left to the parent process, which stops
+    # the child.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    daq = _ChildAcquisition(buffer_name, microcontroller=microcontroller,
+                            read_mode=read_mode, port=port)
+    daq.config = config
+    # The acquisition stops when the parent says so, when the parent
+    # goes, or by itself (see `DataAcquisition.stop`); in every case it
+    # is torn down, so that the process exits.
+    command = None
+    try:
+        try:
+            daq.start(seconds)
+        except Exception as error:
+            conn.send(('error', error))
+            return
+        conn.send(('ok', (daq.mcu.port, daq.mcu.timestamp)))
+
+        while daq.running:
+            if not conn.poll(0.1):
+                continue
+            command, kwargs = conn.recv()
+            result = None
+            try:
+                if command == 'stop':
+                    break
+                elif command == 'start_recording':
+                    daq.start_recording(**kwargs)
+                    result = daq.edffile.filename
+                elif command == 'stop_recording':
+                    daq.stop_recording()
+                elif command == 'stats':
+                    result = daq.stats()
+            except Exception as error:
+                conn.send(('error', error))
+            else:
+                conn.send(('ok', result))
+    except EOFError:
+        # The parent process has gone.
+        pass
+    finally:
+        daq.stop()
+        if daq.y is not None:
+            daq.y.close()
+    if command == 'stop':
+        conn.send(('ok', None))
+
+
+class ProcessAcquisition(object):
+    """
+    Data acquisition in a child process.
+
+    This has the same interface as `acquisition.DataAcquisition`, which
+    runs in the child process: configure, start, stop, record, and read
+    the display buffer `y` (a `SharedRingBuffer`) as described in
+    `DataAcquisition.start`. The configuration is
+    passed on to the child process on `start`.
+
+    Raises ImportError if shared memory is not available (Python < 3.8).
+    """
+
+    # How long (seconds) to wait for the child process to reply.
+    _reply_timeout = 10
+
+    def __init__(self, microcontroller='mbed', read_mode=None, port=None):
+        if shared_memory is None:
+            raise ImportError('Acquisition in a separate process requires '
+                              'Python 3.8 or later')
+        self.config = Configuration()
+        self.microcontroller = microcontroller
+        self.read_mode = read_mode
+        self.port = port
+        # Microcontroller details, as reported by the child process.
+        self.mcu = types.SimpleNamespace(port=None, timestamp=None)
+        self.y = None
+
+        self._process = None
+        self._conn = None
+        self._edffile = None
+        self._context = multiprocessing.get_context('spawn')
+
+    @property
+    def running(self):
+        '''
+        Whether data are being acquired (read-only).
+        '''
+        return self._process is not None and self._process.is_alive()
+
+    @property
+    def recording(self):
+        '''
+        Whether data are being saved to file (read-only).
+        '''
+        return self._edffile is not None and self.running
+
+    @property
+    def edffile(self):
+        '''
+        The EDF file being recorded (only its `filename`), or None
+        (read-only).
+        '''
+        return self._edffile if self.recording else None
+
+    sample_time = DataAcquisition.sample_time
+
+    def _command(self, command, **kwargs):
+        self._conn.send((command, kwargs))
+        return self._reply()
+
+    def _reply(self):
+        if not self._conn.poll(self._reply_timeout):
+            raise SerialException('The acquisition process is not '
+                                  'responding')
+        status, result = self._conn.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def stats(self):
+        '''
+        Return the acquisition counters (see `DataAcquisition.stats`),
+        or None if not running.
+        '''
+        if not self.running:
+            return None
+        try:
+            return self._command('stats')
+        except (EOFError, OSError):
+            # The acquisition process has just stopped by itself.
+            return None
+
+    def start(self, seconds=10):
+        '''
+        Start data acquisition in a child process. See
+        `DataAcquisition.start`.
+        '''
+        if self.running:
+            return
+        self.config.check_link()
+        self._release()
+
+        maxlen = seconds * self.config.sampling_freq
+        slack = DataAcquisition._display_slack * self.config.sampling_freq
+        self.y = SharedRingBuffer(maxlen, self.config.nsignals,
+                                  dtype='uint16', slack=slack)
+
+        self._conn, child_conn = self._context.Pipe()
+        self._process = self._context.Process(
+                target=_run, name='Read-data', daemon=True,
+                args=(child_conn, self.config, self.microcontroller,
+                      self.read_mode, self.port, seconds,
+                      self.y.name))
+        self._process.start()
+        child_conn.close()
+        try:
+            self.mcu.port, self.mcu.timestamp = self._reply()
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            try:
+                self._command('stop')
+            except (EOFError, OSError, SerialException):
+                pass
+        self._process.join(self._reply_timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+        self._conn.close()
+        self._edffile = None
+        # The display buffer keeps the last data read until acquisition
+        # starts again.
+        self.y.unlink()
+
+    def _release(self):
+        # Unmap the display buffer of a previous acquisition.
+        if self.y is not None:
+            self.y.close()
+        self.y = None
+
+    def start_recording(self, policy=None, rotation=None, filename=None):
+        '''
+        Save data to file. See `DataAcquisition.start_recording`.
+        '''
+        if self.recording:
+            return
+        # Check that the data records can be written before starting.
+        self.config.record_duration
+        if not self.running:
+            self.start()
+        filename = self._command('start_recording', policy=policy,
+                                 rotation=rotation, filename=filename)
+        self._edffile = types.SimpleNamespace(filename=filename)
+
+    def stop_recording(self):
+        '''
+        Stop saving data to file. Data acquisition continues.
+        '''
+        if not self.recording:
+            return
+        self._command('stop_recording')
+        self._edffile = None
@@ -0,0 +1,180 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Configuration handshake with the microcontroller.
+
+Version 1 (the original protocol) is a fixed 15-character string,
+'T' + timestamp (10 digits) + 'F' + sampling frequency (3 digits), which
+the microcontroller echoes back as 'seconds frequency packet_size'. The
+sampling frequency cannot exceed 999 Hz and the number of signals is
+not exchanged.
+
+Version 2 messages are self-describing and length-prefixed:
+
+    V002 <length> <payload>\\n
+
+where `length` is the number of characters of `payload` (4 digits) and
+`payload` is a list of ``key=value`` fields separated by semicolons,
+e.g.
+
+    V002 0035 t=1494345706;f=2000;n=3;d=u16;p=400
+
+The host sends the configuration it wants:
+
+    t   Timestamp (seconds since the epoch).
+    f   Base sampling frequency (Hz).
+    n   Number of signals.
+    d   Sample encoding (see `ENCODINGS`).
+    p   Ticks of the sampling frequency per data packet.
+    s   Sampling divider of each signal, separated by commas (optional;
+        see `framing.Demultiplexer`).
+
+and the microcontroller replies with the configuration it will actually
+use (the same keys, `p` possibly adjusted to fit its buffer), plus:
+
+    b   Number of samples (all signals) in each data packet.
+    bmax    Largest number of samples in a data packet (the size of the
+        data buffer).
+    fmax    Highest sampling frequency supported.
+    e   Sample encodings supported, separated by commas.
+
+A data packet holds at least one cycle of the dividers (see
+`cycle_samples`). If a cycle does not fit in the data buffer, the
+microcontroller samples all signals on every tick instead (`s` is all
+1), and the host finds the mismatch.
+
+Unknown keys are ignored, so either side can add fields. Firmware that
+only knows version 1 ignores a version 2 message altogether, so the host
+can fall back to version 1 if there is no reply.
+'''
+
+import math
+
+VERSION = 2
+# Seconds of data in each data packet. Version 1 firmware uses this
+# fixed period; in version 2 the host asks for it (`p`).
+PACKET_PERIOD = 0.2
+# Sample encodings: 'u16' is one little-endian uint16 per sample; 'p12'
+# packs two 12-bit samples in three bytes (see `framing.pack_p12`).
+ENCODINGS = ('u16', 'p12')
+# Bytes of the header that starts each data packet.
+HEADER_BYTES = 4
+# Highest sampling frequency that fits version 1 (3 digits).
+V1_MAX_FREQ = 999
+# Samples (all signals) that the data buffer of the microcontroller
+# holds, i.e. the largest data packet (`BUFFER_SIZE` in the firmware).
+BUFFER_SAMPLES = 1024
+# Largest number of ticks in a cycle of the dividers that the firmware
+# can count (16 bits).
+MAX_CYCLE = 0xffff
+
+
+class ProtocolError(ValueError):
+    """
+    A handshake message that cannot be understood.
+    """
+
+
+def pack(fields, version=VERSION):
+    '''
+    Return the message (bytes) carrying *fields*, a dictionary (or a
+    list of key, value pairs) whose values are numbers, strings or
+    lists of these.
+    '''
+    if isinstance(fields, dict):
+        fields = fields.items()
+    items = []
+    for (key, value) in fields:
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(item) for item in value)
+        items.append('{}={}'.format(key, value))
+    payload = ';'.join(items)
+    if len(payload) > 9999:
+        raise ProtocolError('Message too long')
+    return 'V{:03d} {:04d} {}\n'.format(
+            version, len(payload), payload).encode('ascii')
+
+
+def unpack(message):
+    '''
+    Return the version and the fields (a dictionary of strings) of
+    *message* (bytes, with or without the final new line). Raises
+    `ProtocolError` if the message is malformed or truncated.
+    '''
+    try:
+        message = message.decode('ascii').rstrip('\r\n')
+        (version, length, payload) = message.split(' ', 2)
+        if not version.startswith('V'):
+            raise ValueError
+        version, length = int(version[1:]), int(length)
+    except (UnicodeDecodeError, ValueError):
+        raise ProtocolError('Not a configuration message: {!r}'.format(
+                message))
+    if len(payload) != length:
+        raise ProtocolError('Truncated configuration message: {!r}'.format(
+                message))
+    fields = {}
+    for item in payload.split(';'):
+        (key, sep, value) = item.partition('=')
+        if sep:
+            fields[key.strip()] = value.strip()
+    return version, fields
+
+
+def payload_size(nsamples, encoding='u16'):
+    '''
+    Return the number of bytes taken by *nsamples* samples in a data
+    packet with sample *encoding*.
+    '''
+    if encoding not in ENCODINGS:
+        raise ProtocolError('Unknown sample encoding {}'.format(encoding))
+    if encoding == 'p12':
+        return 3 * ((nsamples + 1) // 2)
+    return 2 * nsamples
+
+
+def cycle_samples(dividers):
+    '''
+    Return the number of ticks in a cycle of the sampling *dividers*
+    (their least common multiple), after which the sampling pattern
+    repeats, and the number of samples (all signals) taken in a cycle.
+    '''
+    cycle = 1
+    for divider in dividers:
+        cycle = cycle * divider // math.gcd(cycle, divider)
+    return cycle, sum(cycle // divider for divider in dividers)
+
+
+def data_rate(sampling_freq, dividers, encoding='u16',
+              packet_period=PACKET_PERIOD):
+    '''
+    Return the bytes per second sent by the microcontroller, headers
+    included, when sampling at *sampling_freq* with the sampling
+    *dividers* of the signals (see `framing.Demultiplexer`).
+
+    Packets span a whole number of cycles of the dividers, about
+    *packet_period* seconds, as set up by the firmware.
+    '''
+    cycle = cycle_samples(dividers)[0]
+    ticks = max(int(sampling_freq * packet_period) // cycle, 1) * cycle
+    nsamples = sum(ticks // divider for divider in dividers)
+    packet_size = HEADER_BYTES + payload_size(nsamples, encoding)
+    return packet_size * sampling_freq / ticks
@@ -25,17 +25,118 @@ if (sys.version_info.major < 3) or (sys.version_info.minor < 5):
              'you are using {}.{}'.format(sys.version_info.major,
                                           sys.version_info.minor))
 
+def acquisition(port=None, process=False):
+    '''
+    Create the data acquisition object: a `DataAcquisition` or, if
+    *process* is True, a `ProcessAcquisition` (acquisition in a separate
+    process).
+    '''
+    if process:
+        try:
+            from process_acquisition import ProcessAcquisition
+            return ProcessAcquisition(port=port)
+        except ImportError as error:
+            sys.exit(error.args[0])
+    from acquisition import DataAcquisition
+    return DataAcquisition(port=port)
+
+
+def record(config_f, output=None, duration=None, port=None,
+           process=False):
+    '''
+    Acquire data and save them to file without a graphical interface.
+
+    The configuration is loaded from *config_f*, and data are saved in
+    *output* (an EDF file name; by default the file is named after the
+    subject and date). Recording continues until interrupted (Ctrl-C or
+    SIGTERM) or, if set, for *duration* seconds. If *process* is True,
+    data are acquired in a separate process.
+
+    This does not import Qt.
+    '''
+    import os
+    import time
+    import signal
+    from serial import SerialException
+    from recording import dropped_warning
+
+    if not os.path.exists(config_f):
+        sys.exit('Configuration file {} not found'.format(config_f))
+
+    daq = acquisition(port, process)
+    try:
+        daq.config.load(config_f)
+    except ValueError as error:
+        sys.exit('Configuration error: {}'.format(error.args[0]))
+
+    # Stop cleanly on Ctrl-C or SIGTERM.
+    interrupted = []
+    def interrupt(signum, frame):
+        interrupted.append(signum)
+    handlers = {signum: signal.signal(signum, interrupt)
+                for signum in (signal.SIGINT, signal.SIGTERM)}
+
+    # If starting fails part way, e.g. the file cannot be created, stop
+    # whatever was started, or the program would not exit.
+    try:
+        daq.start_recording(filename=output)
+    except SerialException as error:
+        daq.stop()
+        sys.exit('Connection error: {}'.format(error.args[0]))
+    except ValueError as error:
+        daq.stop()
+        sys.exit('Configuration error: {}'.format(error.args[0]))
+    except OSError as error:
+        daq.stop()
+        sys.exit('Error creating the EDF file: {}'.format(error))
+    print('Recording to {}'.format(daq.edffile.filename))
+
+    start = time.monotonic()
+    dropped = 0
+    failed = False
+    try:
+        while not interrupted and daq.running:
+            if (duration is not None and
+                    time.monotonic() - start >= duration):
+                break
+            time.sleep(0.2)
+            # Warn as soon as data records are dropped.
+            stats = daq.stats()
+            recorder = stats['recorder'] if stats else None
+            if recorder and recorder['dropped_records'] > dropped:
+                dropped = recorder['dropped_records']
+                print(dropped_warning(recorder), file=sys.stderr)
+        # Acquisition stops by itself if e.g. the microcontroller stops
+        # sending data.
+        failed = not interrupted and not daq.running
+    finally:
+        # From here on, Ctrl-C or SIGTERM stop the program as usual,
+        # even if stopping hangs.
+        for (signum, handler) in handlers.items():
+            signal.signal(signum, handler)
+        daq.stop()
+    print('Stopped after {:.1f} s'.format(time.monotonic() - start))
+    if failed:
+        sys.exit('Acquisition stopped unexpectedly')
+
+
 def main():
     '''
     Arguments:
         --no-gui false -g=false
-        --config -c <configfile.yaml> # required if --no-gui
-        --output -o <outfile.edf> # required if --no-gui
+        --config -c <configfile.ini> # required if --no-gui
+        --output -o <outfile.edf>
+        --duration -d <seconds> # only if --no-gui
+        --port -p <serial port>
+        --process
 
     Defaults
         --gui true
         --config none
         --output none
+        --duration none (record until interrupted)
+        --port none (find the microcontroller by manufacturer)
+        --process false (acquire data in a thread)
     '''
     import argparse
     parser = argparse.ArgumentParser(
@@ -52,21 +153,35 @@ def main():
 
     # File output.
     parser.add_argument('-o', '--output', type=str,
-                        help='output EDF file (required if `--no-gui`)')
+                        help='output EDF file (if `--no-gui`)')
 
     # Configuration file.
     parser.add_argument('-c', '--config', type=str,
                         help='configuration file ' +
                         '(required if `--no-gui`)')
 
-    args = parser.parse_args()
+    # Recording duration.
+    parser.add_argument('-d', '--duration', type=float,
+                        help='recording duration in seconds ' +
+                        '(if `--no-gui`; default: until interrupted)')
+
+    # Serial port.
+    parser.add_argument('-p', '--port', type=str,
+                        help='serial port of the microcontroller ' +
+                        '(default: find it by manufacturer)')
 
+    # Acquisition in a separate process.
+    parser.add_argument('--process', action='store_true',
+                        help='acquire data in a separate process ' +
+                        '(requires Python 3.8)')
+
+    args = parser.parse_args()
+    if not args.gui and not args.config:
+        parser.error('--config is required with --no-gui')
 
-    print('GUI: ', args.gui)
-    if args.config:
-        print('config: ', args.config)
-    if args.output:
-        print('output: ', args.output)
+    if args.gui is False:
+        record(args.config, args.output, args.duration, args.port,
+               args.process)
 
     if args.gui is True:
         import sys
@@ -74,6 +189,10 @@ def main():
         from mainwindow import MainWindow
         app = QtWidgets.QApplication([])
         self = MainWindow()
+        if args.process:
+            self.daq = acquisition(args.port, args.process)
+        else:
+            self.daq.port = args.port
         self.show()
         sys.exit(app.exec_())
         #QtWidgets.QApplication.instance().exec_()
@@ -0,0 +1,478 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import math
+import time
+import queue
+import threading
+import datetime as dt
+
+import numpy as np
+
+
+# When to flush recorded data to disk (see `FlushPolicy`).
+FLUSH_MODES = ('records', 'seconds', 'fsync')
+
+# By default, the queue of data records waiting to be written holds at
+# least this many seconds of data (see `EdfRecorder`).
+QUEUE_SECONDS = 10
+
+
+class FlushPolicy(object):
+    """
+    How often are recorded data flushed to disk.
+
+    mode : :obj:`str`
+        One of `FLUSH_MODES`:
+
+        'records'
+            Flush the file every `every` data records.
+        'seconds'
+            Flush the file every `every` seconds.
+        'fsync'
+            Flush the file and ask the operating system to commit it to
+            disk (`os.fsync`) every `every` seconds.
+
+        Defaults to flushing after every data record.
+    every : :obj:`int` or :obj:`float`
+        Number of data records or seconds between flushes.
+    chunk_size : :obj:`int`
+        Data records are not written one by one but coalesced into
+        chunks of whole data records of at least this many bytes, and
+        each chunk is written in one go. Data are written earlier if a
+        flush is due. Defaults to 64 KiB.
+
+    Data not yet flushed are lost if the program or the computer
+    crash, so the worst-case data loss is roughly `every` records or
+    seconds; with 'fsync', also if power is lost.
+    """
+
+    def __init__(self, mode='records', every=1, chunk_size=65536):
+        if mode not in FLUSH_MODES:
+            raise ValueError('Flush mode {} is not supported'.format(mode))
+        if every <= 0:
+            raise ValueError('Flush interval must be larger than 0')
+        self.mode = mode
+        self.every = every
+        self.chunk_size = int(chunk_size)
+
+    def timeout(self, nrecords, oldest):
+        '''
+        Time (seconds) until the next flush is due, or None if there is
+        nothing to flush or flushing does not depend on time. See `due`.
+        '''
+        if self.mode == 'records' or nrecords == 0:
+            return None
+        return max(oldest + self.every - time.monotonic(), 0)
+
+    def due(self, nrecords, oldest):
+        '''
+        Whether a flush is due when *nrecords* have been written since
+        the last flush, the first of them received at time *oldest*
+        (as given by `time.monotonic`).
+        '''
+        if nrecords == 0:
+            return False
+        if self.mode == 'records':
+            return nrecords >= self.every
+        return time.monotonic() >= oldest + self.every
+
+
+class RotationPolicy(object):
+    """
+    When to start a new EDF file during a long recording.
+
+    minutes : :obj:`float`
+        Start a new file every these many minutes of data.
+    megabytes : :obj:`float`
+        Start a new file when the current one would exceed this size
+        (in MB, 10**6 bytes).
+
+    Either or both can be set; a new file is started whenever one of the
+    limits is reached. Files are always split at a data record boundary.
+    """
+
+    def __init__(self, minutes=None, megabytes=None):
+        if minutes is None and megabytes is None:
+            raise ValueError('Either minutes or megabytes must be set')
+        self.minutes = minutes
+        self.megabytes = megabytes
+
+    def records_per_file(self, record_duration, record_bytes):
+        '''
+        Number of data records of *record_duration* seconds and
+        *record_bytes* bytes in each file.
+        '''
+        limits = []
+        if self.minutes is not None:
+            limits.append(math.ceil(self.minutes * 60 / record_duration))
+        if self.megabytes is not None:
+            limits.append(int(self.megabytes * 1e6 // record_bytes))
+        return max(min(limits), 1)
+
+
+def dropped_warning(stats):
+    '''
+    Return a warning about the data records dropped so far, given the
+    recorder's *stats* (see `EdfRecorder.stats`).
+    '''
+    return ('Warning: {} data records ({:.1f} s) dropped because the disk '
+            'is too slow; the EDF file has gaps and the times of later '
+            'samples are shifted'.format(stats['dropped_records'],
+                                         stats['dropped_seconds']))
+
+
+class EdfRecorder(object):
+    """
+    Write EDF data records to file in a background thread.
+
+    Complete data records are handed over with `submit` and queued; a
+    writer thread takes them from the queue and writes them to the EDF
+    file. Thus slow disk writes do not hold up the thread reading from
+    the serial port. If the queue is full (i.e. the disk has been slow
+    for longer than the queue can hold), new records are dropped and
+    counted in `dropped_records`. Each dropped record leaves a gap in the
+    file, which shifts the time of all later samples; the caller should
+    warn about it (see `stats`).
+
+    The records themselves are recycled: `submit` returns an empty
+    record taken from a preallocated pool in exchange for the one
+    submitted, which goes back to the pool once copied into the writer's
+    chunk buffer. How often data are written and flushed to disk is set
+    by `policy`.
+
+    Long recordings can be split into several files (segments) by
+    setting `rotation`. A new segment starts at a data record boundary
+    and its header start time follows on from the previous one. The
+    list of segments is kept in a JSON file, `manifest`. All this is
+    done in the writer thread.
+
+    edffile : :obj:`edfrw.EdfWriter`
+        The open EDF file. It is closed by `close`.
+    record_size : :obj:`int`
+        Number of samples (all signals) in one data record.
+    dtype : :obj:`numpy.dtype`
+        Data type of the samples. Defaults to little-endian uint16.
+    queue_size : :obj:`int`
+        Maximum number of data records waiting to be written. By
+        default, enough for `QUEUE_SECONDS` seconds of data, and no
+        fewer than 8.
+    policy : :obj:`FlushPolicy`
+        How often data are flushed to disk. Defaults to `FlushPolicy()`,
+        i.e. after every data record.
+    rotation : :obj:`RotationPolicy`
+        When to start a new file. Defaults to None (a single file).
+    open_segment : callable
+        Required if `rotation` is set. Called as
+        ``open_segment(index, start)`` to create the `index`-th segment
+        (counting from 0, which is `edffile`) with start time `start`
+        (a `datetime`); it must return a new :obj:`edfrw.EdfWriter`.
+    manifest : :obj:`str`
+        Name of the JSON file listing the segments. Only used if
+        `rotation` is set.
+    """
+
+    def __init__(self, edffile, record_size, dtype='<u2', queue_size=None,
+                 policy=None, rotation=None, open_segment=None,
+                 manifest=None):
+        self.edffile = edffile
+        self._record_duration = edffile.header.duration_of_data_record
+        if queue_size is None:
+            queue_size = 8
+            if self._record_duration > 0:
+                queue_size = max(int(math.ceil(
+                        QUEUE_SECONDS / self._record_duration)), 8)
+        self.queue_size = queue_size
+        if policy is None:
+            policy = FlushPolicy()
+        self.policy = policy
+
+        # File rotation.
+        self.rotation = rotation
+        self._open_segment = open_segment
+        self.manifest = manifest
+        header = edffile.header
+        self._start = dt.datetime.combine(header.startdate,
+                                          header.starttime)
+        self._records_per_file = None
+        if rotation is not None:
+            if open_segment is None:
+                raise ValueError('open_segment is required for rotation')
+            self._records_per_file = rotation.records_per_file(
+                    header.duration_of_data_record,
+                    record_size * np.dtype(dtype).itemsize)
+        self.segments = []
+        self._add_segment(edffile, 0)
+        self._queue = queue.Queue(maxsize=queue_size)
+        # One spare record for each place in the queue plus the one
+        # being written. With this, there is always a spare record when
+        # the queue is not full.
+        self._pool = queue.Queue()
+        for n in range(queue_size + 1):
+            self._pool.put(np.zeros(record_size, dtype=dtype))
+
+        # Records are copied into this buffer and written in chunks of
+        # whole records.
+        nrecords = max(policy.chunk_size //
+                       (record_size * np.dtype(dtype).itemsize), 1)
+        self._chunk = np.zeros((nrecords, record_size), dtype=dtype)
+        self._nchunk = 0
+
+        # Counters.
+        self.records_written = 0
+        self.dropped_records = 0
+        self.max_queue_depth = 0
+        self.last_write_latency = 0
+        self.max_write_latency = 0
+        self.flushes = 0
+        self.max_flush_delay = 0
+        self.error = None
+        # Time at which the oldest record not yet flushed was received.
+        self._unflushed_since = None
+
+        self._thread = threading.Thread(target=self._write,
+                                        name='Write-EDF')
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        '''
+        Number of data records waiting to be written (read-only).
+        '''
+        return self._queue.qsize()
+
+    @property
+    def unflushed_age(self):
+        '''
+        Seconds since the oldest data record not yet flushed to disk was
+        received by the writer, or 0 if all have been flushed
+        (read-only). Unlike `max_flush_delay`, this includes records
+        whose flush is still pending.
+        '''
+        since = self._unflushed_since
+        if since is None:
+            return 0
+        return time.monotonic() - since
+
+    def submit(self, record):
+        '''
+        Queue *record* to be written to file. Returns an empty record
+        to be filled next, or None if the record was dropped (in which
+        case *record* can be reused).
+        '''
+        if self.error is not None:
+            self.dropped_records += 1
+            return None
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+            return None
+        self.max_queue_depth = max(self.max_queue_depth,
+                                   self._queue.qsize())
+        return self._pool.get_nowait()
+
+    def stats(self):
+        '''
+        Return a dictionary with the current recording counters.
+        '''
+        return {'records_written': self.records_written,
+                'dropped_records': self.dropped_records,
+                'dropped_seconds': (self.dropped_records *
+                                    self._record_duration),
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'last_write_latency': self.last_write_latency,
+                'max_write_latency': self.max_write_latency,
+                'flushes': self.flushes,
+                'max_flush_delay': self.max_flush_delay}
+
+    def close(self):
+        '''
+        Write any records still waiting in the queue and close the
+        file.
+        '''
+        self._queue.put(None)
+        self._thread.join()
+        # If starting a new segment failed, the current one is already
+        # closed, and listed as the last one in the manifest.
+        try:
+            if not self.edffile.closed:
+                self.edffile.close()
+            self._write_manifest()
+        except OSError as error:
+            print('Error closing {}: {}'.format(self.edffile.filename,
+                                                error))
+            if self.error is None:
+                self.error = error
+
+    def _write(self):
+        policy = self.policy
+        # Number of records written since the last flush, and time at
+        # which the first of them was received.
+        unflushed = 0
+        oldest = None
+        while True:
+            try:
+                record = self._queue.get(
+                        timeout=policy.timeout(unflushed, oldest))
+            except queue.Empty:
+                record = False
+            if record is None:
+                break
+            if record is not False:
+                self._chunk[self._nchunk] = record
+                self._pool.put(record)
+                self._nchunk += 1
+                if unflushed == 0:
+                    oldest = time.monotonic()
+                    self._unflushed_since = oldest
+                unflushed += 1
+                if self._nchunk == len(self._chunk):
+                    self._write_chunk()
+            if policy.due(unflushed, oldest):
+                self._flush(oldest)
+                unflushed = 0
+                self._unflushed_since = None
+        # Closing down.
+        if unflushed:
+            self._flush(oldest)
+            self._unflushed_since = None
+
+    def _write_chunk(self):
+        # Write all the records in the chunk buffer in one go.
+        nrecords = self._nchunk
+        if nrecords == 0:
+            return
+        self._nchunk = 0
+        if self.error is not None:
+            return
+        start = time.monotonic()
+        first = 0
+        while first < nrecords:
+            count = nrecords - first
+            if self._records_per_file is not None:
+                # Start a new segment if the current one is full, and do
+                # not write more records than fit in the segment.
+                written = self.edffile.header.number_of_data_records
+                if written >= self._records_per_file:
+                    if not self._rotate():
+                        return
+                    written = 0
+                count = min(count, self._records_per_file - written)
+            # `write_data_record` counts one data record per call, and
+            # then writes the count in the header. Count the rest of the
+            # chunk beforehand, so that the header written matches the
+            # data.
+            header = self.edffile.header
+            header.number_of_data_records += count - 1
+            try:
+                self.edffile.write_data_record(
+                        self._chunk[first:first+count])
+            except OSError as error:
+                # E.g. the disk is full. Stop writing; further records
+                # will be dropped.
+                print('Error writing {}: {}'.format(
+                        self.edffile.filename, error))
+                header.number_of_data_records -= count - 1
+                self.error = error
+                return
+            first += count
+        latency = time.monotonic() - start
+        self.last_write_latency = latency
+        self.max_write_latency = max(self.max_write_latency, latency)
+        self.records_written += nrecords
+
+    def _flush(self, oldest):
+        self._write_chunk()
+        if self.error is not None:
+            return
+        try:
+            self.edffile.update_number_of_records()
+            self.edffile.flush()
+            if self.policy.mode == 'fsync':
+                # EdfWriter does not expose the file descriptor.
+                os.fsync(self.edffile._f.fileno())
+        except OSError as error:
+            print('Error writing {}: {}'.format(
+                    self.edffile.filename, error))
+            self.error = error
+            return
+        self.flushes += 1
+        self.max_flush_delay = max(self.max_flush_delay,
+                                   time.monotonic() - oldest)
+
+    def _rotate(self):
+        # Close the current segment and open the next one. Returns
+        # False if this fails.
+        first_record = (self.segments[-1]['first_record'] +
+                        self.edffile.header.number_of_data_records)
+        duration = self.edffile.header.duration_of_data_record
+        start = self._start + dt.timedelta(
+                seconds=first_record * duration)
+        try:
+            if self.policy.mode == 'fsync':
+                self.edffile.update_number_of_records()
+                self.edffile.flush()
+                os.fsync(self.edffile._f.fileno())
+            self.edffile.close()
+            self._write_manifest()
+            edffile = self._open_segment(len(self.segments), start)
+        except OSError as error:
+            print('Error starting a new EDF file: {}'.format(error))
+            self.error = error
+            return False
+        self.edffile = edffile
+        self._add_segment(edffile, first_record)
+        return True
+
+    def _add_segment(self, edffile, first_record):
+        self.segments.append({
+                'filename': os.path.basename(edffile.filename),
+                'start': '{:%Y-%m-%dT%H:%M:%S}'.format(
+                        dt.datetime.combine(edffile.header.startdate,
+                                            edffile.header.starttime)),
+                'first_record': first_record,
+                # Offset of the first sample of each signal from the
+                # start of the recording.
+                'first_sample': [
+                        first_record *
+                        signal.number_of_samples_in_data_record
+                        for signal in edffile.header.signals],
+                'number_of_data_records': 0})
+
+    def _write_manifest(self):
+        # Write the list of segments, replacing the previous manifest
+        # only once the new one is complete.
+        if self.rotation is None or self.manifest is None:
+            return
+        self.segments[-1]['number_of_data_records'] = \
+            self.edffile.header.number_of_data_records
+        manifest = {
+                'start': self.segments[0]['start'],
+                'duration_of_data_record':
+                    self.edffile.header.duration_of_data_record,
+                'segments': self.segments}
+        tmp = self.manifest + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp, self.manifest)
@@ -0,0 +1,457 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A simulated microcontroller on a pseudo-terminal.
+
+`MCUSimulator` behaves as the mbed running `firmware/mbed-daq/main.cpp`:
+it waits for a configuration message (protocol version 1 or 2, see
+`protocol`), confirms it, and then sends data packets at the requested
+sampling rate until reset. Signals can be sampled at divisors of the
+sampling rate (see `framing.Demultiplexer`). The host connects to it as
+to any serial port, e.g.
+
+>>> sim = MCUSimulator(nsignals=8)
+>>> sim.start()
+>>> daq = DataAcquisition(port=sim.port)
+
+or, from the command line,
+
+    python3 simulator.py --nsignals 8
+    python3 pydaq.py --port /dev/pts/3
+
+Linux only.
+'''
+
+import os
+import tty
+import time
+import select
+import threading
+
+import numpy as np
+
+import protocol
+from framing import pack_p12
+HEADER = b'\xff\xff\xff\xff'
+WAVEFORMS = ('ramp', 'sine')
+
+
+class MCUSimulator(object):
+    """
+    Microcontroller simulator.
+
+    nsignals : :obj:`int`
+        Number of signals sent in each data packet.
+    baud : :obj:`int`
+        Baud rate of the simulated link. Data are not sent faster than
+        the link allows (10 bits per byte). If None, data are sent as
+        fast as the pseudo-terminal takes them.
+    packet_period : :obj:`float`
+        Time in seconds covered by each data packet. By default, that
+        requested by the host (protocol version 2) or
+        `protocol.PACKET_PERIOD` (version 1).
+    waveform : :obj:`str`
+        One of `WAVEFORMS`. With 'ramp' (the default), signal `n`
+        carries the value ``(sample_index + 100 * n) % 4096``, so that
+        lost or corrupted samples can be detected by the host; with
+        'sine', 12-bit sine waves of different frequencies.
+    drop_rate : :obj:`float`
+        Probability of dropping one byte from a data packet.
+    corrupt_rate : :obj:`float`
+        Probability of corrupting the header of a data packet.
+    stall_every : :obj:`float`
+        If set, stop sending data every these many seconds...
+    stall_duration : :obj:`float`
+        ...for these many seconds. Samples acquired meanwhile are sent
+        (late) once the stall is over.
+    seed : :obj:`int`
+        Seed for the random faults.
+    protocols : :obj:`tuple` of :obj:`int`
+        Versions of the configuration protocol understood. Messages of
+        other versions are ignored, as by older firmware.
+    max_freq : :obj:`int`
+        Highest sampling frequency supported (protocol version 2).
+    buffer_size : :obj:`int`
+        Largest number of samples in a data packet (protocol version 2).
+    encodings : :obj:`tuple` of :obj:`str`
+        Sample encodings supported (protocol version 2, see
+        `protocol.ENCODINGS`). The first one is the default.
+    """
+
+    def __init__(self, nsignals=3, baud=115200, packet_period=None,
+                 waveform='ramp', drop_rate=0, corrupt_rate=0,
+                 stall_every=None, stall_duration=0, seed=None,
+                 protocols=(1, 2), max_freq=50000, buffer_size=65536,
+                 encodings=protocol.ENCODINGS):
+        if waveform not in WAVEFORMS:
+            raise ValueError('Waveform {} is not supported'.format(
+                    waveform))
+        self.nsignals = nsignals
+        self.baud = baud
+        self.packet_period = packet_period
+        self.waveform = waveform
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.stall_every = stall_every
+        self.stall_duration = stall_duration
+        self._random = np.random.RandomState(seed)
+        self.protocols = protocols
+        self.max_freq = max_freq
+        self.buffer_size = buffer_size
+        self.encodings = encodings
+
+        self.port = None
+        self.sampling_freq = None
+        self.dividers = [1] * nsignals
+        self.encoding = encodings[0]
+        self.output_size = 0
+        # Ticks of the sampling frequency covered by each packet.
+        self._ticks = 0
+        self._master = None
+        self._slave = None
+        self._running = False
+        self._streaming = threading.Event()
+        self._lock = threading.Lock()
+
+        # Counters.
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_dropped = 0
+        self.packets_corrupted = 0
+
+    def start(self):
+        '''
+        Open the pseudo-terminal and wait for the host. The port to
+        connect to is `port`.
+        '''
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._rx_thread = threading.Thread(target=self._receive,
+                                           name='Simulator-rx')
+        self._tx_thread = threading.Thread(target=self._send,
+                                           name='Simulator-tx')
+        self._rx_thread.daemon = True
+        self._tx_thread.daemon = True
+        self._rx_thread.start()
+        self._tx_thread.start()
+
+    def stop(self):
+        self._running = False
+        self._streaming.set()
+        self._rx_thread.join()
+        self._tx_thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, ctx_type, ctx_value, ctx_traceback):
+        self.stop()
+
+    # Host to MCU ------------------------------------------------------
+
+    def _receive(self):
+        # Read and interpret the commands sent by the host.
+        pending = b''
+        while self._running:
+            readable = select.select([self._master], [], [], 0.1)[0]
+            if not readable:
+                continue
+            try:
+                pending += os.read(self._master, 1024)
+            except OSError:
+                break
+            pending = self._parse(pending)
+
+    def _parse(self, pending):
+        # Process the commands in `pending` and return any leftover
+        # (incomplete) command.
+        while pending:
+            char = pending[:1]
+            if char == b'R':
+                self.reset()
+                pending = pending[1:]
+            elif char == b'T' and 1 in self.protocols:
+                # 'T', seconds (10 digits), 'F', frequency (3 digits).
+                if len(pending) < 15:
+                    break
+                self.configure(pending[1:15])
+                pending = pending[15:]
+            elif char == b'V' and 2 in self.protocols:
+                # A version 2 message, up to the new line.
+                end = pending.find(b'\n')
+                if end < 0:
+                    break
+                self.configure_v2(pending[:end+1])
+                pending = pending[end+1:]
+            elif char == b'D' and 1 in self.protocols:
+                # 'D', dividers separated by commas, new line.
+                end = pending.find(b'\n')
+                if end < 0:
+                    break
+                self.set_dividers(pending[1:end])
+                pending = pending[end+1:]
+            else:
+                # Anything else is ignored, as by the firmware.
+                pending = pending[1:]
+        return pending
+
+    def reset(self):
+        self._streaming.clear()
+        with self._lock:
+            self.output_size = 0
+            self.dividers = [1] * self.nsignals
+            self.encoding = self.encodings[0]
+
+    def set_dividers(self, dividers):
+        '''
+        Set the sampling divider of each signal as the firmware does
+        with the string that follows the 'D' command, e.g.
+        b'001,002,010'. Invalid settings are ignored.
+        '''
+        try:
+            dividers = [int(divider)
+                        for divider in dividers.decode('ascii').split(',')]
+        except ValueError:
+            return
+        if len(dividers) != self.nsignals or min(dividers) < 1:
+            return
+        with self._lock:
+            self.dividers = dividers
+
+    def configure(self, config):
+        '''
+        Configure as the firmware does with the string that follows the
+        'T' command, e.g. b'1234567890F100'.
+        '''
+        try:
+            seconds, freq = config.decode('ascii').split('F')
+            seconds, freq = int(seconds), float(freq)
+        except ValueError:
+            return
+        packet_period = self.packet_period or protocol.PACKET_PERIOD
+        with self._lock:
+            # Version 1 only sends unpacked samples.
+            self.encoding = 'u16'
+            self._setup(seconds, freq, int(freq * packet_period))
+        self._write('{:d} {:3.0f} {:d}\n'.format(
+                seconds, freq, self.output_size).encode('ascii'))
+        self._streaming.set()
+
+    def configure_v2(self, message):
+        '''
+        Configure with a protocol version 2 *message* (see `protocol`)
+        and reply with the configuration actually used. Messages that
+        cannot be understood are ignored.
+        '''
+        try:
+            version, fields = protocol.unpack(message)
+            seconds = int(fields['t'])
+            freq = int(fields['f'])
+            ticks = int(fields.get('p', 0))
+            dividers = [int(divider) for divider in
+                        fields.get('s', '').split(',') if divider]
+        except (protocol.ProtocolError, KeyError, ValueError):
+            return
+        if version != 2:
+            return
+        # Settings that cannot be met are replaced by those that can.
+        freq = min(freq, self.max_freq)
+        encoding = fields.get('d')
+        if encoding not in self.encodings:
+            encoding = self.encodings[0]
+        if len(dividers) != self.nsignals or min(dividers) < 1:
+            dividers = [1] * self.nsignals
+        if self.packet_period or ticks < 1:
+            ticks = int(freq * (self.packet_period or
+                                protocol.PACKET_PERIOD))
+        with self._lock:
+            self.dividers = dividers
+            self.encoding = encoding
+            self._setup(seconds, freq, ticks)
+        self._write(protocol.pack([
+                ('t', seconds), ('f', freq), ('n', self.nsignals),
+                ('d', encoding), ('p', self._ticks), ('s', self.dividers),
+                ('b', self.output_size), ('bmax', self.buffer_size),
+                ('fmax', self.max_freq),
+                ('e', self.encodings)]))
+        self._streaming.set()
+
+    def _setup(self, seconds, freq, ticks):
+        # Set up acquisition at `freq` with (about) `ticks` per packet.
+        self.timestamp = seconds
+        self.sampling_freq = freq
+        # Each packet covers a whole number of cycles of the dividers,
+        # so that all packets have the same layout, and fits in the
+        # buffer. If a cycle does not fit, all signals are sampled on
+        # every tick, as by the firmware.
+        (cycle, per_cycle) = protocol.cycle_samples(self.dividers)
+        if per_cycle > self.buffer_size or cycle > protocol.MAX_CYCLE:
+            self.dividers = [1] * self.nsignals
+            (cycle, per_cycle) = protocol.cycle_samples(self.dividers)
+        ncycles = max(min(ticks // cycle,
+                          self.buffer_size // per_cycle), 1)
+        self._ticks = ncycles * cycle
+        self.output_size = ncycles * per_cycle
+
+    # MCU to host ------------------------------------------------------
+
+    def _write(self, data):
+        # Write as much as the pseudo-terminal takes at a time, so that
+        # the simulator can be stopped even if the host is not reading.
+        data = memoryview(data)
+        while data and self._running:
+            if not select.select([], [self._master], [], 0.1)[1]:
+                continue
+            try:
+                data = data[os.write(self._master, data):]
+            except BlockingIOError:
+                pass
+            except OSError:
+                break
+
+    def _samples(self, first, nrows):
+        # Generate the samples of `nrows` ticks, starting at tick
+        # `first`: on each tick, one sample of every signal due.
+        index = np.arange(first, first + nrows)[:, np.newaxis]
+        signals = np.arange(self.nsignals)
+        if self.waveform == 'ramp':
+            samples = (index + 100 * signals) % 4096
+        else:
+            phase = 2 * np.pi * index / self.sampling_freq
+            samples = 2047 + 2000 * np.sin(phase * (signals + 1))
+        samples = samples[index % self.dividers == 0]
+        if self.encoding == 'p12':
+            return pack_p12(samples)
+        return samples.astype('<u2').tobytes()
+
+    def _packet(self, first, nrows):
+        packet = bytearray(HEADER + self._samples(first, nrows))
+        if self._random.random_sample() < self.corrupt_rate:
+            packet[self._random.randint(len(HEADER))] = 0
+            self.packets_corrupted += 1
+        if self._random.random_sample() < self.drop_rate:
+            del packet[self._random.randint(len(packet))]
+            self.packets_dropped += 1
+        return bytes(packet)
+
+    def _send(self):
+        while self._running:
+            self._streaming.wait()
+            if not self._running:
+                break
+            with self._lock:
+                nrows = self._ticks
+                freq = self.sampling_freq
+            start = time.monotonic()
+            link_free = start
+            next_stall = (start + self.stall_every
+                          if self.stall_every else None)
+            npackets = 0
+            while self._streaming.is_set() and self._running:
+                # Wait until the samples of the next packet have been
+                # acquired.
+                due = start + (npackets + 1) * nrows / freq
+                if next_stall is not None and due >= next_stall:
+                    due = max(due, next_stall + self.stall_duration)
+                    next_stall += self.stall_every
+                packet = self._packet(npackets * nrows, nrows)
+                # ...and until the link can take it.
+                if self.baud:
+                    link_free = (max(due, link_free) +
+                                 len(packet) * 10 / self.baud)
+                    due = link_free
+                delay = due - time.monotonic()
+                if delay > 0 and self._wait_reset(delay):
+                    break
+                self._write(packet)
+                npackets += 1
+                self.packets_sent += 1
+                self.bytes_sent += len(packet)
+
+    def _wait_reset(self, delay):
+        # Sleep for `delay` seconds. Returns True if the simulator was
+        # reset or stopped in the meantime.
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline:
+            time.sleep(min(deadline - time.monotonic(), 0.05))
+            if not self._streaming.is_set() or not self._running:
+                return True
+        return False
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+            description='Simulate a microcontroller on a pseudo-terminal')
+    parser.add_argument('-n', '--nsignals', type=int, default=3)
+    parser.add_argument('-b', '--baud', type=int, default=115200,
+                        help='baud rate (0: unlimited)')
+    parser.add_argument('--packet-period', type=float, default=None,
+                        help='seconds of data in each packet (default: '
+                             'as requested by the host, or {})'.format(
+                                     protocol.PACKET_PERIOD))
+    parser.add_argument('--waveform', choices=WAVEFORMS, default='ramp')
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help='probability of dropping a byte per packet')
+    parser.add_argument('--corrupt-rate', type=float, default=0,
+                        help='probability of corrupting a packet header')
+    parser.add_argument('--stall-every', type=float, default=None,
+                        help='stall every these many seconds')
+    parser.add_argument('--stall-duration', type=float, default=0,
+                        help='duration of each stall in seconds')
+    parser.add_argument('--protocol', type=int, nargs='+',
+                        default=[1, 2],
+                        help='configuration protocol versions understood')
+    parser.add_argument('--max-freq', type=int, default=50000,
+                        help='highest sampling frequency (Hz)')
+    parser.add_argument('--encodings', nargs='+',
+                        default=list(protocol.ENCODINGS),
+                        choices=protocol.ENCODINGS,
+                        help='sample encodings supported')
+    args = parser.parse_args()
+
+    sim = MCUSimulator(nsignals=args.nsignals, baud=args.baud or None,
+                       packet_period=args.packet_period,
+                       waveform=args.waveform, drop_rate=args.drop_rate,
+                       corrupt_rate=args.corrupt_rate,
+                       stall_every=args.stall_every,
+                       stall_duration=args.stall_duration,
+                       protocols=tuple(args.protocol),
+                       max_freq=args.max_freq,
+                       encodings=tuple(args.encodings))
+    sim.start()
+    print('Simulated microcontroller on {}'.format(sim.port), flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2016-2017 Antonio González
+#
+# This file is part of pydaq.
+#
+# Pydaq is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Pydaq is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pydaq. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Counters and timers for the data acquisition loop.
+
+These are cheap enough to be updated on every iteration of the loop and
+are always on: timing a stage costs two calls to `time.perf_counter` and
+adding the result to a `Histogram` a few integer operations.
+'''
+
+import time
+from collections import OrderedDict
+
+# Stages of `DataAcquisition._read`, in order.
+#   'wait':    waiting for data in the serial input buffer.
+#   'read':    copying the data from the serial port.
+#   'frame':   splitting the data into packets and unpacking samples.
+#   'display': adding the samples to the display buffers.
+#   'record':  adding the samples to the EDF data record.
+STAGES = ('wait', 'read', 'frame', 'display', 'record')
+
+
+class Histogram(object):
+    """
+    Histogram of durations in power-of-two buckets.
+
+    Bucket `n` counts the durations `d` (in microseconds) such that
+    ``2**(n-1) <= d < 2**n``, bucket 0 those under 1 µs. The last bucket
+    (about 36 minutes and over) counts all longer durations.
+    """
+
+    nbuckets = 32
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * self.nbuckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        '''
+        Add a duration in seconds.
+        '''
+        bucket = int(seconds * 1e6).bit_length()
+        if bucket >= self.nbuckets:
+            bucket = self.nbuckets - 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        '''
+        Return an upper bound (in seconds) of the given percentile, i.e.
+        the upper edge of the bucket where it falls, or None if the
+        histogram is empty.
+        '''
+        if self.count == 0:
+            return None
+        target = self.count * percent / 100
+        cumulative = 0
+        for (bucket, count) in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                # The largest duration is a tighter upper bound.
+                return min(2**bucket / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        '''
+        Return a dictionary with the summary statistics (in seconds)
+        and the non-empty buckets, keyed by their upper edge in µs.
+        '''
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else None,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'buckets': OrderedDict(
+                        (2**bucket, count) for (bucket, count) in
+                        enumerate(self.counts) if count)}
+
+
+class AcquisitionStats(object):
+    """
+    Counters and per-stage timers of the data acquisition loop.
+
+    bytes_read : :obj:`int`
+        Bytes read from the serial port.
+    reads : :obj:`int`
+        Number of reads from the serial port.
+    max_in_waiting : :obj:`int`
+        Largest number of bytes found waiting in the serial input
+        buffer. If this approaches the size of the buffer (4095 bytes),
+        data are about to be lost.
+    stages : :obj:`dict` of :obj:`Histogram`
+        Time spent on each stage of the loop (see `STAGES`).
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict((stage, Histogram()) for stage in STAGES)
+        self.clear()
+
+    def clear(self):
+        self.started = time.monotonic()
+        self.bytes_read = 0
+        self.reads = 0
+        self.max_in_waiting = 0
+        for histogram in self.stages.values():
+            histogram.clear()
+
+    def snapshot(self):
+        return OrderedDict([
+                ('elapsed', time.monotonic() - self.started),
+                ('bytes_read', self.bytes_read),
+                ('reads', self.reads),
+                ('max_in_waiting', self.max_in_waiting),
+                ('stages', OrderedDict(
+                        (stage, histogram.snapshot())
+                        for (stage, histogram) in self.stages.items())),
+                ])